@@ -1,10 +1,92 @@
 import requests
+import copy
+import fcntl
+import hashlib
 import os
+import shutil
+import signal
+import socket
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from gigablast_hash import GigablastHash
 from urllib.parse import urlparse
 import json
 
+def parse_cpu_list(cpu_list):
+    """Parse a cpu list like '0-3,8,10-11' into a sorted list of cpu numbers"""
+    cpus = set()
+    for item in cpu_list.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last if last else first) + 1))
+
+    return sorted(cpus)
+
+
+class GigablastGovernor:
+    """Per-host token bucket rate limiter and max in-flight request limiter"""
+    def __init__(self, max_qps=0, max_inflight=0, burst=1):
+        self.max_qps = max_qps
+        self.max_inflight = max_inflight
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_refill = time.perf_counter()
+        self._inflight = threading.BoundedSemaphore(max_inflight) if max_inflight > 0 else None
+        self._lock = threading.Lock()
+
+        self.num_requests = 0
+        self.total_queued = 0.0
+        self.max_queued = 0.0
+
+    def acquire(self):
+        start_time = time.perf_counter()
+
+        if self._inflight:
+            self._inflight.acquire()
+
+        if self.max_qps > 0:
+            with self._lock:
+                now = time.perf_counter()
+                self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self.max_qps)
+                self._last_refill = now
+
+                # reserve a token; a negative balance is the time we have to wait for it
+                self._tokens -= 1
+                wait_time = -self._tokens / self.max_qps if self._tokens < 0 else 0
+
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+        queued = time.perf_counter() - start_time
+        with self._lock:
+            self.num_requests += 1
+            self.total_queued += queued
+            self.max_queued = max(self.max_queued, queued)
+
+    def release(self):
+        if self._inflight:
+            self._inflight.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {'requests': self.num_requests,
+                    'total_queued': self.total_queued,
+                    'avg_queued': (self.total_queued / self.num_requests) if self.num_requests else 0.0,
+                    'max_queued': self.max_queued}
+
+
 class GigablastAPI:
     class _HTTPStatus:
         @staticmethod
@@ -19,13 +101,95 @@ class GigablastAPI:
         def record_not_found():
             return 'Record not found'
 
+    class _SharedCall:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    # governors are shared by all api objects talking to the same gb host
+    _governors = {}
+    _governors_lock = threading.Lock()
+    _max_qps = 0
+    _max_inflight = 0
+
+    # identical idempotent requests in flight, shared by all api objects
+    _shared_calls = {}
+    _shared_calls_lock = threading.Lock()
+
     def __init__(self, host, port):
         self._host = host
         self._port = port
+        self._governor = self._get_governor(host, port)
+
+    @classmethod
+    def set_governor_limits(cls, max_qps=0, max_inflight=0):
+        with cls._governors_lock:
+            cls._max_qps = max_qps
+            cls._max_inflight = max_inflight
+            cls._governors = {}
+
+    @classmethod
+    def _get_governor(cls, host, port):
+        with cls._governors_lock:
+            key = (host, port)
+            if key not in cls._governors:
+                cls._governors[key] = GigablastGovernor(cls._max_qps, cls._max_inflight)
+
+            return cls._governors[key]
+
+    @classmethod
+    def get_governor_stats(cls):
+        with cls._governors_lock:
+            governors = dict(cls._governors)
+
+        return {'%s:%d' % key: governor.get_stats() for key, governor in governors.items()}
 
     def _get_url(self, path):
         return 'http://' + self._host + ':' + str(self._port) + '/' + path
 
+    def _get(self, path, payload):
+        with self._governor:
+            return requests.get(self._get_url(path), params=payload)
+
+    def _get_json_shared(self, path, payload):
+        # concurrent callers asking the same host for the same thing wait for a single request
+        key = (self._host, self._port, path, tuple(sorted((k, str(v)) for k, v in payload.items())))
+
+        with self._shared_calls_lock:
+            call = self._shared_calls.get(key)
+            is_owner = call is None
+            if is_owner:
+                call = self._SharedCall()
+                self._shared_calls[key] = call
+
+        if not is_owner:
+            call.done.wait()
+            if call.error is not None:
+                # a new exception per waiter, so tracebacks don't pile up on the owner's. Same type for
+                # Exceptions, so callers catching e.g. ConnectionError still do
+                if isinstance(call.error, Exception):
+                    error = copy.copy(call.error)
+                else:
+                    error = RuntimeError('shared request for %s aborted: %r' % (path, call.error))
+                raise error from call.error
+
+            return call.result
+
+        try:
+            call.result = self._get(path, payload).json()
+        except BaseException as e:
+            # waiters must not wake up to a None result, e.g. on KeyboardInterrupt in the owner
+            call.error = e
+            raise
+        finally:
+            with self._shared_calls_lock:
+                del self._shared_calls[key]
+
+            call.done.set()
+
+        return call.result
+
     @staticmethod
     def _apply_default_payload(payload):
         payload.setdefault('c', 'main')
@@ -46,21 +210,21 @@ class GigablastAPI:
     def _config_search(self, payload):
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/search'), params=payload)
+        response = self._get('admin/search', payload)
 
         return response.json()
 
     def _config_settings(self, payload):
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/settings'), params=payload)
+        response = self._get('admin/settings', payload)
 
         return response.json()
 
     def _config_spider(self, payload):
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/spider'), params=payload)
+        response = self._get('admin/spider', payload)
 
         return response.json()
 
@@ -72,7 +236,7 @@ class GigablastAPI:
 
         payload.update({'url': url})
 
-        response = requests.get(self._get_url('admin/inject'), params=payload)
+        response = self._get('admin/inject', payload)
 
         return response.json()
 
@@ -90,14 +254,14 @@ class GigablastAPI:
 
         payload.update({'urls': url})
 
-        response = requests.get(self._get_url('admin/addurl'), params=payload)
+        response = self._get('admin/addurl', payload)
 
         return response.json()
 
     def config_master(self, payload):
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/master'), params=payload)
+        response = self._get('admin/master', payload)
 
         return response.json()
 
@@ -119,21 +283,21 @@ class GigablastAPI:
     def config_urlfilters(self, payload):
         self._apply_default_payload(payload)
 
-        request = requests.get(self._get_url('admin/filters'), params=payload)
+        request = self._get('admin/filters', payload)
 
         return request.json()
 
     def config_log(self, payload):
         self._apply_default_payload(payload)
 
-        request = requests.get(self._get_url('admin/log'), params=payload)
+        request = self._get('admin/log', payload)
 
         return request.json()
 
     def config_search(self, payload):
         self._apply_default_payload(payload)
 
-        request = requests.get(self._get_url('admin/search'), params=payload)
+        request = self._get('admin/search', payload)
 
         return request.json()
 
@@ -154,7 +318,7 @@ class GigablastAPI:
 
         payload.update({'type': type, 'key': key})
 
-        response = requests.get(self._get_url('admin/docprocess'), params=payload)
+        response = self._get('admin/docprocess', payload)
         return response.json()
 
     def doc_delete(self, key):
@@ -180,7 +344,7 @@ class GigablastAPI:
         payload.update({'d': doc_id})
 
         try:
-            response = requests.get(self._get_url('get'), params=payload)
+            response = self._get('get', payload)
             return response.json()
         except requests.exceptions.ConnectionError as e:
             if self._check_http_status(e, self._HTTPStatus.record_not_found()):
@@ -192,8 +356,7 @@ class GigablastAPI:
         payload = {}
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/spiderdb'), params=payload)
-        return response.json()
+        return self._get_json_shared('admin/spiderdb', payload)
 
     def inject_url(self, url):
         return self._inject(url)
@@ -207,7 +370,7 @@ class GigablastAPI:
         payload = {'url': url}
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/linkdblookup'), params=payload)
+        response = self._get('admin/linkdblookup', payload)
 
         return response.json()
 
@@ -215,7 +378,7 @@ class GigablastAPI:
         payload = {'url': url}
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/spiderdblookup'), params=payload)
+        response = self._get('admin/spiderdblookup', payload)
 
         return response.json()
 
@@ -226,7 +389,7 @@ class GigablastAPI:
         payload.update({'u': url})
 
         try:
-            response = requests.get(self._get_url('get'), params=payload)
+            response = self._get('get', payload)
             return response.json()
         except requests.exceptions.ConnectionError as e:
             if self._check_http_status(e, self._HTTPStatus.record_not_found()):
@@ -241,7 +404,7 @@ class GigablastAPI:
                    'tagdata0': tag_data}
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/tagdb'), params=payload)
+        response = self._get('admin/tagdb', payload)
 
         return response.json()
 
@@ -250,10 +413,15 @@ class GigablastAPI:
                    'get': 1}
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/tagdb'), params=payload)
+        response = self._get('admin/tagdb', payload)
 
         return response.json()
 
+    def reset_collection(self, collection='main'):
+        payload = {'reset': collection}
+
+        return self.config_master(payload)
+
     def save(self):
         payload = {'js': '1'}
         self.config_master(payload)
@@ -276,33 +444,294 @@ class GigablastAPI:
         if len(query):
             payload.update({'q': query})
 
-        response = requests.get(self._get_url('search'), params=payload)
+        response = self._get('search', payload)
 
         return response.json()
 
+    def iter_search(self, query, payload=None, page_size=10, prefetch=False):
+        if not payload:
+            payload = {}
+
+        def search_page(offset):
+            page_payload = dict(payload)
+            page_payload.update({'s': offset, 'n': page_size})
+            return self.search(query, page_payload)
+
+        # fetch next page in the background while the caller consumes the current one
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        try:
+            offset = 0
+            response = search_page(offset)
+            while True:
+                results = response.get('results', [])
+                has_more = (len(results) == page_size and response.get('moreResultsFollow', 1) != 0)
+
+                next_page = None
+                if has_more and executor:
+                    next_page = executor.submit(search_page, offset + page_size)
+
+                for result in results:
+                    yield result
+
+                if not has_more:
+                    break
+
+                offset += page_size
+                response = next_page.result() if next_page else search_page(offset)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
     def status(self, payload=None):
         if not payload:
             payload = {}
 
         self._apply_default_payload(payload)
 
-        response = requests.get(self._get_url('admin/status'), params=payload)
-
-        return response.json()
+        return self._get_json_shared('admin/status', payload)
 
     def status_processstarttime(self):
         return self.status()['response']['processStartTime']
 
 
+class PortAllocator:
+    """Claim free ports shared between concurrent runs using lock files in a shared directory"""
+    def __init__(self, lock_dir):
+        self._lock_dir = lock_dir
+        self._locks = {}
+
+        os.makedirs(lock_dir, exist_ok=True)
+
+    @staticmethod
+    def is_port_free(port):
+        for sock_type in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+            with socket.socket(socket.AF_INET, sock_type) as sock:
+                try:
+                    sock.bind(('', port))
+                except OSError:
+                    return False
+
+        return True
+
+    def _lock_port(self, port):
+        if port in self._locks:
+            return False
+
+        lock_file = open(os.path.join(self._lock_dir, 'port-%d.lock' % port), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._locks[port] = lock_file
+        return True
+
+    def _unlock_port(self, port):
+        lock_file = self._locks.pop(port)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def claim(self, ports):
+        claimed = []
+        for port in ports:
+            if not self._lock_port(port):
+                break
+
+            claimed.append(port)
+
+            if not self.is_port_free(port):
+                break
+        else:
+            return True
+
+        for port in claimed:
+            self._unlock_port(port)
+
+        return False
+
+    def claim_block(self, first_port, last_port, size, offsets=(0,)):
+        for base_port in range(first_port, last_port - size + 1, size):
+            ports = [base_port + offset + i for offset in offsets for i in range(size)]
+            if self.claim(ports):
+                return base_port
+
+        raise RuntimeError('No free block of %d ports between %d and %d' % (size, first_port, last_port))
+
+    def release(self):
+        for port in list(self._locks):
+            self._unlock_port(port)
+
+
+class GigablastSupervisor:
+    """Track gb instance processes by pid and probe their listening ports"""
+    def __init__(self, instances, host='127.0.0.1'):
+        self._instances = instances
+        self._host = host
+        self.start_latencies = {}
+        self.stop_latencies = {}
+        # instances still running after the last stop, by host id
+        self.stop_failures = {}
+
+    def find_pids(self):
+        # gb runs with its instance directory as working directory
+        instance_paths = {os.path.realpath(self._instances.get_instance_path(host_id)): host_id
+                          for host_id in range(self._instances.num_instances)}
+
+        pids = {}
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+
+            try:
+                cwd = os.readlink(os.path.join(entry.path, 'cwd'))
+                exe = os.readlink(os.path.join(entry.path, 'exe'))
+            except OSError:
+                continue
+
+            if cwd in instance_paths and os.path.basename(exe).split(' ')[0] == 'gb':
+                pids[instance_paths[cwd]] = int(entry.name)
+
+        return pids
+
+    def is_listening(self, host_id):
+        try:
+            with socket.create_connection((self._host, self._instances.get_instance_port(host_id)), timeout=0.2):
+                return True
+        except OSError:
+            return False
+
+    def wait_ready(self, timeout=300, pid_interval=0.5, pid_grace=10):
+        """Wait until instances listen. Instances whose gb process is gone (or never showed up within pid_grace
+        seconds) are given up on instead of waiting for the timeout"""
+        start_time = time.perf_counter()
+        self.start_latencies = {}
+
+        pending = set(range(self._instances.num_instances))
+        started = set()
+        pid_time = None
+        while pending and time.perf_counter() - start_time < timeout:
+            for host_id in sorted(pending):
+                if self.is_listening(host_id):
+                    self.start_latencies[host_id] = time.perf_counter() - start_time
+                    pending.discard(host_id)
+
+            # scanning /proc is expensive, so look for exited instances less often than probing ports
+            if pending and (pid_time is None or time.perf_counter() - pid_time >= pid_interval):
+                pid_time = time.perf_counter()
+                pids = self.find_pids()
+                started.update(pids)
+                for host_id in sorted(pending):
+                    if host_id not in pids and (host_id in started or pid_time - start_time >= pid_grace):
+                        print('Instance %d is not running' % host_id)
+                        pending.discard(host_id)
+
+            if pending:
+                time.sleep(0.05)
+
+        return self.start_latencies
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    def _wait_pids(self, pids, start_time, deadline):
+        while pids and time.perf_counter() < deadline:
+            for host_id, pid in list(pids.items()):
+                if not self.is_running(pid):
+                    self.stop_latencies[host_id] = time.perf_counter() - start_time
+                    del pids[host_id]
+
+            if pids:
+                time.sleep(0.05)
+
+    def _signal_pids(self, pids, sig):
+        for host_id, pid in pids.items():
+            print('Sending signal %d to instance %d (pid %d)' % (sig, host_id, pid))
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def wait_exit(self, pids, timeout=60, term_timeout=10, kill_timeout=5):
+        start_time = time.perf_counter()
+        self.stop_latencies = {}
+
+        pids = dict(pids)
+        self._wait_pids(pids, start_time, start_time + timeout)
+
+        # escalate for instances that don't exit by themselves
+        if pids:
+            self._signal_pids(pids, signal.SIGTERM)
+            self._wait_pids(pids, start_time, time.perf_counter() + term_timeout)
+
+        if pids:
+            self._signal_pids(pids, signal.SIGKILL)
+            self._wait_pids(pids, start_time, time.perf_counter() + kill_timeout)
+
+        self.stop_failures = pids
+        return self.stop_latencies
+
+    def _stop_instance(self, host_id):
+        # save_and_exit ignores connection errors, it always gets its connection aborted
+        if not self.is_listening(host_id):
+            print('Instance %d is not listening on port %d' % (host_id, self._instances.get_instance_port(host_id)))
+            return False
+
+        try:
+            GigablastAPI(self._host, self._instances.get_instance_port(host_id)).save_and_exit()
+            return True
+        except Exception as e:
+            print('Unable to stop instance %d - %s' % (host_id, e))
+            return False
+
+    def stop_instances(self, timeout=60, term_timeout=10, kill_timeout=5, pids=None):
+        """Ask every instance to save and exit concurrently, escalating for the ones that don't.
+        Returns None if no instance process was found"""
+        if pids is None:
+            pids = self.find_pids()
+
+        if not pids:
+            self.stop_failures = {}
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(pids)) as executor:
+            stopping = dict(zip(sorted(pids), executor.map(self._stop_instance, sorted(pids))))
+
+        # no point waiting for instances that didn't get the request
+        self._signal_pids({host_id: pid for host_id, pid in pids.items() if not stopping[host_id]}, signal.SIGTERM)
+
+        return self.wait_exit(pids, timeout, term_timeout, kill_timeout)
+
+
 class GigablastInstances:
-    def __init__(self, offset, path, num_instances, num_shards, port):
+    def __init__(self, offset, path, num_instances, num_shards, port, clean_workers=0, clean_in_background=False,
+                 use_snapshots=False, warm_pool=False, ram_path=None, data_paths=None, merge_scope='global',
+                 cpus=None):
         self.offset = offset
         self._path = path
+        # instance data and merge space may live on a RAM-backed filesystem or be striped across several disks
+        # instead of next to the gb binary
+        self._ram_path = ram_path
+        if data_paths:
+            self._data_paths = list(data_paths)
+        elif ram_path:
+            self._data_paths = [ram_path]
+        else:
+            self._data_paths = [path]
         self.num_instances = num_instances
         self.num_shards = num_shards
         self._num_mirrors = (num_instances / num_shards) - 1
-        self._merge_space_path = os.path.normpath(os.path.join(path, 'instances%02d/merge_space' % num_instances))
-        self._merge_lock_path = os.path.normpath(os.path.join(path, 'instances%02d/merge_lock' % num_instances))
+        # merge space/lock shared by all hosts on a data path ('global'), or one per 'shard' or 'host'
+        self.merge_scope = merge_scope
         port_offset = offset * 10
         executor_number = os.getenv('EXECUTOR_NUMBER')
         if executor_number is not None:
@@ -310,8 +739,217 @@ class GigablastInstances:
 
         self._port = port + port_offset
 
+        self.clean_workers = clean_workers
+        self.clean_in_background = clean_in_background
+        self.use_snapshots = use_snapshots
+
+        self.supervisor = GigablastSupervisor(self)
+
+        # cpus shared out between instances when pinning
+        self.cpus = cpus
+        # before the runner pins itself, so gb doesn't inherit the runner's cpus
+        self._start_cpus = os.sched_getaffinity(0)
+
+        # keep gb running between testcases
+        self.warm_pool = warm_pool
+        self.pool_running = False
+        # custom config applied since the last start/reset
+        self.pool_customized = False
+        self.pool_num_resets = 0
+        self.pool_saved_time = 0.0
+        self.cold_start_elapsed = None
+        self.cold_stop_elapsed = None
+
+    def allocate_ports(self, allocator, first_port=22000, last_port=28000):
+        # dnsclient/https/http/udp ports are at -2000/-1000/0/+1000 from the http port (see create_hostfile)
+        self._port = allocator.claim_block(first_port, last_port, self.num_instances, (-2000, -1000, 0, 1000))
+        return self._port
+
+    def load_hostfile_ports(self):
+        """Use the ports of the installed hosts.conf, eg. claimed by a run with --allocate-ports.
+        Returns the http port, or None if hosts.conf isn't for these instances"""
+        try:
+            with open(os.path.join(self._path, 'hosts.conf'), 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        for line in lines:
+            # <host id> <dnsclient port> <https port> <http port> <udp port> <ip> <ip> <instance path> ...
+            fields = line.split()
+            if len(fields) >= 8 and fields[0] == '0':
+                if fields[7] != self.get_instance_path(0):
+                    return None
+
+                self._port = int(fields[3])
+                return self._port
+
+        return None
+
+    def get_data_paths(self):
+        return self._data_paths
+
+    def _get_data_path(self, host_id):
+        # stripe instances round-robin across the data paths
+        return self._data_paths[host_id % len(self._data_paths)]
+
+    def _get_instances_path(self, host_id=0):
+        return '%s/instances%02d' % (self._get_data_path(host_id), self.num_instances)
+
+    def get_merge_paths(self, host_id):
+        instances_path = os.path.normpath(self._get_instances_path(host_id))
+        merge_space_path = os.path.join(instances_path, 'merge_space')
+        merge_lock_path = os.path.join(instances_path, 'merge_lock')
+
+        if self.merge_scope == 'shard':
+            suffix = '.shard%03d' % (host_id % self.num_shards)
+        elif self.merge_scope == 'host':
+            suffix = '.host%03d' % host_id
+        else:
+            suffix = ''
+
+        return merge_space_path + suffix, merge_lock_path + suffix
+
+    def get_all_merge_paths(self):
+        return sorted(set(self.get_merge_paths(host_id) for host_id in range(self.num_instances)))
+
+    @staticmethod
+    def _get_fs_type(path):
+        fs_type = None
+        mount_point = ''
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if ((os.path.realpath(path) + '/').startswith(fields[1].rstrip('/') + '/') and
+                        len(fields[1]) >= len(mount_point)):
+                    mount_point = fields[1]
+                    fs_type = fields[2]
+
+        return fs_type
+
+    @staticmethod
+    def _get_used_space(path):
+        used = 0
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                try:
+                    used += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    pass
+
+        return used
+
+    @staticmethod
+    def _get_mem_available():
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+
+        return None
+
+    def check_data_paths(self, size_per_instance):
+        """Verify the data paths can hold size_per_instance bytes for every instance placed on them"""
+        errors = []
+
+        # data paths may share a filesystem, so sum up per device
+        required = {}
+        free = {}
+        ram_required = 0
+        for index, data_path in enumerate(self._data_paths):
+            host_ids = [host_id for host_id in range(self.num_instances) if host_id % len(self._data_paths) == index]
+            if not host_ids:
+                continue
+
+            instances_path = self._get_instances_path(host_ids[0])
+            os.makedirs(instances_path, exist_ok=True)
+
+            fs_type = self._get_fs_type(instances_path)
+            if data_path == self._ram_path and fs_type not in ('tmpfs', 'ramfs'):
+                print('Warning: %s is on %s, not a RAM-backed filesystem' % (data_path, fs_type))
+
+            # data already placed there doesn't need more room
+            path_required = max(0, len(host_ids) * size_per_instance - self._get_used_space(instances_path))
+
+            stat = os.statvfs(instances_path)
+            device = os.stat(instances_path).st_dev
+            required[device] = required.get(device, 0) + path_required
+            free[device] = (stat.f_bavail * stat.f_frsize, data_path)
+
+            if fs_type in ('tmpfs', 'ramfs'):
+                ram_required += path_required
+
+        for device, device_required in required.items():
+            device_free, data_path = free[device]
+            if device_required > device_free:
+                errors.append('Not enough room in %s: need %d MB, free %d MB' %
+                              (data_path, device_required // 2**20, device_free // 2**20))
+
+        mem_available = self._get_mem_available()
+        if mem_available is not None and ram_required > mem_available:
+            errors.append('Not enough memory for RAM-backed instances: need %d MB, available memory %d MB' %
+                          (ram_required // 2**20, mem_available // 2**20))
+
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+
+    def check_ports(self):
+        """Verify the dnsclient/https/http/udp port ranges are valid and don't overlap"""
+        if self.num_instances > 1000:
+            raise RuntimeError('Port ranges overlap with %d instances (max 1000)' % self.num_instances)
+
+        first_port = self._port - 2000
+        last_port = self._port + 1000 + self.num_instances - 1
+        if first_port < 1024 or last_port > 65535:
+            raise RuntimeError('Port range %d-%d is outside 1024-65535' % (first_port, last_port))
+
+        busy_ports = [port for band in (-2000, -1000, 0, 1000) for port in range(self._port + band, self._port + band + self.num_instances)
+                      if not PortAllocator.is_port_free(port)]
+        if busy_ports:
+            print('Warning: ports already in use - %s' % ' '.join(str(port) for port in busy_ports))
+
+    def validate_topology(self, size_per_instance):
+        self.check_ports()
+        self.check_data_paths(size_per_instance)
+
     def get_instance_path(self, host_id):
-        return '%s/instances%02d/%s' % (self._path, self.num_instances, str(host_id).zfill(3))
+        return '%s/%s' % (self._get_instances_path(host_id), str(host_id).zfill(3))
+
+    def get_instance_cpus(self, host_id):
+        # disjoint slices when there are enough cpus, otherwise one cpu each round-robin
+        if len(self.cpus) < self.num_instances:
+            return [self.cpus[host_id % len(self.cpus)]]
+
+        per_instance = len(self.cpus) // self.num_instances
+        return self.cpus[host_id * per_instance:(host_id + 1) * per_instance]
+
+    def get_start_command(self, command):
+        """Run command on all gb cpus (or the cpus we started with) until pin_instances narrows it.
+        taskset sets the affinity before exec, so everything gb spawns inherits it"""
+        cpus = set(self.cpus or self._start_cpus)
+        if cpus == os.sched_getaffinity(0) or shutil.which('taskset') is None:
+            return command
+
+        return ['taskset', '-c', ','.join(str(cpu) for cpu in sorted(cpus))] + command
+
+    def pin_instances(self):
+        """Pin every thread of each running instance to its cpu slice"""
+        pinned = {}
+        if not self.cpus:
+            return pinned
+
+        for host_id, pid in self.supervisor.find_pids().items():
+            cpus = self.get_instance_cpus(host_id)
+            try:
+                # affinity is per thread, threads created later inherit it from their creator
+                for task in os.listdir('/proc/%d/task' % pid):
+                    os.sched_setaffinity(int(task), cpus)
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+
+            pinned[host_id] = cpus
+
+        return pinned
 
     def get_instance_port(self, host_id):
         return self._port + host_id
@@ -326,26 +964,231 @@ class GigablastInstances:
                 return "noquery"
 
     def create_hostfile(self):
-        with open(os.path.join(self._path, 'hosts.conf'), 'w') as f:
-            f.write('num-mirrors: %d\n' % self._num_mirrors)
+        lines = ['num-mirrors: %d\n' % self._num_mirrors]
 
-            dnsclient_port = self._port - 2000
-            https_port = self._port - 1000
-            http_port = self._port
-            udp_port = self._port + 1000
+        dnsclient_port = self._port - 2000
+        https_port = self._port - 1000
+        http_port = self._port
+        udp_port = self._port + 1000
 
-            for host_id in range(self.num_instances):
-                instance_path = self.get_instance_path(host_id)
-                instance_type = self.get_instance_type(host_id)
-                f.write('%d %d %d %d %d 127.0.0.1 127.0.0.1 %s %s %s %s\n' %
-                        (host_id, dnsclient_port + host_id, https_port + host_id, http_port + host_id,
-                         udp_port + host_id, instance_path, self._merge_space_path, self._merge_lock_path, instance_type))
+        for host_id in range(self.num_instances):
+            instance_path = self.get_instance_path(host_id)
+            instance_type = self.get_instance_type(host_id)
+            merge_space_path, merge_lock_path = self.get_merge_paths(host_id)
+            lines.append('%d %d %d %d %d 127.0.0.1 127.0.0.1 %s %s %s %s\n' %
+                         (host_id, dnsclient_port + host_id, https_port + host_id, http_port + host_id,
+                          udp_port + host_id, instance_path, merge_space_path, merge_lock_path, instance_type))
+
+        content = ''.join(lines)
+
+        # leave an unchanged hosts.conf alone so its mtime stays stable
+        hostfile_path = os.path.join(self._path, 'hosts.conf')
+        if os.path.exists(hostfile_path):
+            with open(hostfile_path, 'r') as f:
+                if f.read() == content:
+                    return content
+
+        with open(hostfile_path, 'w') as f:
+            f.write(content)
+
+        return content
+
+    def _get_manifest_path(self, host_id):
+        return os.path.join(self.get_instance_path(host_id), '.pywebtest-manifest.json')
+
+    def _read_manifest(self, host_id):
+        try:
+            with open(self._get_manifest_path(host_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_manifest(self, host_id, manifest):
+        manifest_path = self._get_manifest_path(host_id)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _get_install_key(self, hostfile_content):
+        # reinstall when hosts.conf or the gb binary changes
+        key = hashlib.sha1(hostfile_content.encode())
+        try:
+            stat = os.stat(os.path.join(self._path, 'gb'))
+            key.update(('%d %d' % (stat.st_mtime_ns, stat.st_size)).encode())
+        except FileNotFoundError:
+            pass
+
+        return key.hexdigest()
+
+    def install_files(self, src_dir, filenames):
+        """Copy files from src_dir to all instances, skipping instances that already have the same content"""
+        hashes = {}
+        for filename in filenames:
+            with open(os.path.join(src_dir, filename), 'rb') as f:
+                hashes[filename] = hashlib.sha1(f.read()).hexdigest()
+
+        installed = set()
+        for host_id in range(self.num_instances):
+            instance_path = self.get_instance_path(host_id)
+            manifest = self._read_manifest(host_id)
+
+            changed = False
+            for filename in filenames:
+                src_file = os.path.join(src_dir, filename)
+                dest_file = os.path.join(instance_path, filename)
+                if manifest.get(filename) == hashes[filename] and os.path.exists(dest_file):
+                    continue
+
+                if os.path.realpath(src_file) != os.path.realpath(dest_file):
+                    shutil.copy2(src_file, dest_file)
+
+                manifest[filename] = hashes[filename]
+                installed.add(filename)
+                changed = True
+
+            if changed:
+                self._write_manifest(host_id, manifest)
+
+        return installed
+
+    def _get_template_path(self, host_id):
+        return '%s/.template/%s' % (self._get_instances_path(host_id), str(host_id).zfill(3))
+
+    def _discard(self, host_id, paths):
+        # rename out of the way (cheap) and let a detached rm do the slow part
+        trash_path = os.path.join(self._get_instances_path(host_id), '.trash', '%03d-%d' % (host_id, time.time_ns()))
+        os.makedirs(trash_path)
+
+        for path in paths:
+            os.rename(path, os.path.join(trash_path, os.path.basename(path)))
+
+        subprocess.Popen(['rm', '-rf', trash_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    def _move_data_aside(self, host_id):
+        instance_path = self.get_instance_path(host_id)
+        self._discard(host_id, [entry.path for entry in os.scandir(instance_path)
+                                if entry.is_dir(follow_symlinks=False) and entry.name.startswith('coll.')])
+
+    @staticmethod
+    def _link_or_copy(src, dst):
+        # gb never writes to its executables, so those can be shared
+        if os.access(src, os.X_OK):
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError:
+                pass
+
+        return shutil.copy2(src, dst)
+
+    def _clone_tree(self, src, dst):
+        # reflink when the filesystem supports it, otherwise hardlink/copy
+        if subprocess.call(['cp', '-a', '--reflink=always', src, dst], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+            return
+
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst, symlinks=True, copy_function=self._link_or_copy)
+
+    def _get_snapshot_stamp(self):
+        # templates are stale once gb or hosts.conf has been updated
+        stamp = []
+        for filename in ['gb', 'hosts.conf']:
+            try:
+                stat = os.stat(os.path.join(self._path, filename))
+                stamp.append('%s %d %d' % (filename, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamp.append('%s missing' % filename)
+
+        return '\n'.join(stamp) + '\n'
+
+    def _get_snapshot_stamp_path(self):
+        return os.path.join(self._get_instances_path(), '.template', 'stamp')
+
+    def has_snapshots(self):
+        try:
+            with open(self._get_snapshot_stamp_path(), 'r') as f:
+                return f.read() == self._get_snapshot_stamp()
+        except FileNotFoundError:
+            return False
+
+    def create_snapshot(self, host_id):
+        template_path = self._get_template_path(host_id)
+        if os.path.exists(template_path):
+            self._discard(host_id, [template_path])
+
+        subprocess.call(['./gbclean.sh'], cwd=self.get_instance_path(host_id), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._clone_tree(self.get_instance_path(host_id), template_path)
+
+    def create_snapshots(self):
+        stamp_path = self._get_snapshot_stamp_path()
+        os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+
+        max_workers = self.clean_workers if self.clean_workers > 0 else self.num_instances
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.create_snapshot, range(self.num_instances)))
+
+        with open(stamp_path, 'w') as f:
+            f.write(self._get_snapshot_stamp())
+
+    def restore_snapshot(self, host_id):
+        start_time = time.perf_counter()
+
+        instance_path = self.get_instance_path(host_id)
+        if os.path.exists(instance_path):
+            self._discard(host_id, [instance_path])
+
+        self._clone_tree(self._get_template_path(host_id), instance_path)
+
+        return time.perf_counter() - start_time
+
+    def clean_instance(self, host_id):
+        start_time = time.perf_counter()
+
+        if self.clean_in_background:
+            self._move_data_aside(host_id)
+
+        subprocess.call(['./gbclean.sh'], cwd=self.get_instance_path(host_id), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        return time.perf_counter() - start_time
+
+    def clean_instances(self):
+        if self.use_snapshots:
+            if not self.has_snapshots():
+                self.create_snapshots()
+
+            reset_instance = self.restore_snapshot
+        else:
+            reset_instance = self.clean_instance
+
+        max_workers = self.clean_workers if self.clean_workers > 0 else self.num_instances
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(reset_instance, range(self.num_instances)))
+
+    def add_warm_reset(self, elapsed):
+        self.pool_num_resets += 1
+
+        if self.cold_start_elapsed is None:
+            return None
+
+        saved = self.cold_start_elapsed + (self.cold_stop_elapsed or 0.0) - elapsed
+        self.pool_saved_time += saved
+        return saved
 
     def create_instances(self):
-        self.create_hostfile()
+        install_key = self._get_install_key(self.create_hostfile())
+
+        if any(self._read_manifest(host_id).get('install') != install_key for host_id in range(self.num_instances)):
+            subprocess.call(['./gb', 'install'], cwd=self._path, stdout=subprocess.DEVNULL)
+
+            # gb install may have overwritten previously installed files
+            for host_id in range(self.num_instances):
+                self._write_manifest(host_id, {'install': install_key})
 
-        subprocess.call(['./gb', 'install'], cwd=self._path, stdout=subprocess.DEVNULL)
-        subprocess.call(['./gb', 'installfile', 'gbclean.sh'], cwd=self._path, stdout=subprocess.DEVNULL)
+        self.install_files(self._path, ['gbclean.sh'])
 
 
 class GigablastUtils:
@@ -4,10 +4,12 @@
 import os
 import re
 import subprocess
+import time
 from webserver import TestWebServer
+from synthetic_sites import read_synth_config
 from testrunner import TestRunner
 from junit_xml import TestSuite
-from gigablast import GigablastInstances
+from gigablast import GigablastAPI, GigablastInstances, PortAllocator, parse_cpu_list
 
 
 def natural_sort(l):
@@ -16,13 +18,52 @@ def natural_sort(l):
     return sorted(l, key=alphanum_key)
 
 
-def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host, gb_port, ws_domain, ws_port, ws_sslport, ws_sslkey, ws_sslcert, output_file):
+def print_governor_stats():
+    for host, stats in sorted(GigablastAPI.get_governor_stats().items()):
+        print('gb %s - requests=%d queued total=%.3fs avg=%.3fs max=%.3fs' %
+              (host, stats['requests'], stats['total_queued'], stats['avg_queued'], stats['max_queued']))
+
+
+def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host, gb_port, ws_domain, ws_port, ws_sslport, ws_sslkey, ws_sslcert, output_file,
+         gb_max_qps=0, gb_max_inflight=0, gb_clean_workers=0, gb_clean_in_background=False,
+         gb_use_snapshots=False, gb_warm_pool=False, port_lock_dir=None, gb_ram_path=None, gb_instance_size=512,
+         resource_interval=0, gb_data_paths=None, gb_merge_scope='global', gb_cpus=None, ws_cpus=None, runner_cpus=None,
+         ws_engine='threads', ws_keep_alive=False, ws_idle_timeout=5.0, ws_synth_config=None, ws_tls_protocol='TLSv1'):
+    # keep gb, webserver and runner off each other's cpus
+    cpu_sets = [cpus for cpus in (gb_cpus, ws_cpus, runner_cpus) if cpus]
+    if len(set(cpu for cpus in cpu_sets for cpu in cpus)) != sum(len(cpus) for cpus in cpu_sets):
+        print('Warning: gigablast/webserver/runner cpu sets overlap')
+
+    # limit request rate towards each gb host
+    GigablastAPI.set_governor_limits(gb_max_qps, gb_max_inflight)
+
     # prepare gigablast
-    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port)
+    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port,
+                                      gb_clean_workers, gb_clean_in_background, gb_use_snapshots,
+                                      gb_warm_pool, gb_ram_path, gb_data_paths, gb_merge_scope, gb_cpus)
 
     # prepare webserver
-    ws_port += gb_offset
-    ws_sslport += gb_offset
+    port_allocator = None
+    if port_lock_dir:
+        # claim free port blocks instead of deriving them from the offset
+        port_allocator = PortAllocator(port_lock_dir)
+
+        gb_port = gb_instances.allocate_ports(port_allocator)
+
+        ws_port = port_allocator.claim_block(30000, 32000, 2)
+        ws_sslport = ws_port + 1
+
+        print('Allocated gigablast port %d, webserver ports %d/%d' % (gb_port, ws_port, ws_sslport))
+    else:
+        ws_port += gb_offset
+        ws_sslport += gb_offset
+
+    # same checks as setup_instances.py, on the ports this run will use and before gb is started
+    gb_instances.validate_topology(gb_instance_size * 2**20)
+
+    if port_allocator:
+        # reinstall hosts.conf with the claimed ports
+        gb_instances.create_instances()
 
     script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -33,20 +74,59 @@ def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host,
         subprocess.call(['./create_ssl_cert.sh', ws_domain], stdout=subprocess.DEVNULL, cwd=script_dir)
 
     # start webserver
-    test_webserver = TestWebServer(testdir, ws_port, ws_sslport, ws_sslkey, ws_sslcert)
+    test_webserver = TestWebServer(testdir, ws_port, ws_sslport, ws_sslkey, ws_sslcert, cpus=ws_cpus,
+                                   engine=ws_engine, keep_alive=ws_keep_alive, idle_timeout=ws_idle_timeout,
+                                   synth_config=read_synth_config(ws_synth_config) if ws_synth_config else None,
+                                   tls_protocol=ws_tls_protocol)
+
+    if runner_cpus:
+        # only this thread and the threads it starts from now on. The webserver threads are already running,
+        # and gb is started with its own cpus (see GigablastInstances.get_start_command)
+        os.sched_setaffinity(0, runner_cpus)
 
     # run testcases
     testcases = natural_sort(next(os.walk(testdir))[1])
     results = []
+    total_time = 0.0
     for testcase in testcases:
         print('Running testcase -', testcase)
+        start_time = time.perf_counter()
         test_webserver.clear_served_urls()
-        test_runner = TestRunner(testdir, testcase, gb_instances, gb_host, test_webserver, ws_domain, ws_port, ws_sslport)
+        test_runner = TestRunner(testdir, testcase, gb_instances, gb_host, test_webserver, ws_domain, ws_port, ws_sslport,
+                                 resource_interval)
         results.append(test_runner.run_test())
 
+        elapsed = time.perf_counter() - start_time
+        total_time += elapsed
+        print('Testcase %s took %.3f seconds' % (testcase, elapsed))
+
+    if len(testcases):
+        print('Ran %d testcases in %.3f seconds (avg %.3f seconds) with instance data in %s' %
+              (len(testcases), total_time, total_time / len(testcases), ', '.join(gb_instances.get_data_paths())))
+
+    # stop gigablast left running by the warm pool
+    if gb_instances.pool_running:
+        print('Stopping gigablast')
+        if gb_instances.supervisor.stop_instances() is None:
+            GigablastAPI(gb_host, gb_instances.get_instance_port(0)).save_and_exit()
+        gb_instances.pool_running = False
+
+    if gb_instances.warm_pool:
+        print('Warm pool reused gigablast %d times, saved %.3f seconds' %
+              (gb_instances.pool_num_resets, gb_instances.pool_saved_time))
+
     # stop webserver
     test_webserver.stop()
 
+    cache_stats = test_webserver.get_cache_stats()
+    print('Webserver content cache hit rate %.1f%% (%d hits, %d misses), saved reading %d bytes' %
+          (cache_stats['hit_rate'] * 100, cache_stats['hits'], cache_stats['misses'], cache_stats['bytes_saved']))
+
+    if port_allocator:
+        port_allocator.release()
+
+    print_governor_stats()
+
     # write output
     with open(output_file, 'w') as f:
         TestSuite.to_file(f, results)
@@ -73,6 +153,45 @@ if __name__ == '__main__':
                         help='Gigablast host (default: 127.0.0.1)')
     parser.add_argument('--port', dest='gb_port', type=int, default=28000, action='store',
                         help='Gigablast port (default: 28000')
+    parser.add_argument('--max-qps', dest='gb_max_qps', type=float, default=0, action='store',
+                        help='Maximum requests per second sent to each gigablast host (default: 0, unlimited)')
+    parser.add_argument('--max-inflight', dest='gb_max_inflight', type=int, default=0, action='store',
+                        help='Maximum concurrent requests to each gigablast host (default: 0, unlimited)')
+    parser.add_argument('--clean-workers', dest='gb_clean_workers', type=int, default=0, action='store',
+                        help='Number of instances cleaned concurrently (default: 0, all instances)')
+    parser.add_argument('--clean-in-background', dest='gb_clean_in_background', action='store_true',
+                        help='Move instance data aside and delete it in the background')
+    parser.add_argument('--use-snapshots', dest='gb_use_snapshots', action='store_true',
+                        help='Reset instances by cloning a pristine template instead of running gbclean.sh')
+    parser.add_argument('--warm-pool', dest='gb_warm_pool', action='store_true',
+                        help='Keep gigablast running between testcases and reset the collection instead')
+    parser.add_argument('--allocate-ports', dest='port_lock_dir', nargs='?', const='/tmp/pywebtest-ports', action='store',
+                        help='Claim free gigablast/webserver ports using lock files in the given directory '
+                             '(default: /tmp/pywebtest-ports) and reinstall hosts.conf with them')
+    parser.add_argument('--ram-path', dest='gb_ram_path', default=None, action='store',
+                        help='Place instance data and merge space in this RAM-backed directory (eg. /dev/shm/gb)')
+    parser.add_argument('--data-path', dest='gb_data_paths', default=None, action='append',
+                        help='Place instance data and merge space in this directory; repeat to stripe instances across disks')
+    parser.add_argument('--merge-scope', dest='gb_merge_scope', default='global', choices=['global', 'shard', 'host'],
+                        help='Share merge space/lock between all hosts on a data path, or give each shard/host its own (default: global)')
+    parser.add_argument('--instance-size', dest='gb_instance_size', type=int, default=512, action='store',
+                        help='Space in MB needed per instance in --ram-path/--data-path (default: 512)')
+    parser.add_argument('--sample-interval', dest='resource_interval', type=float, default=0, action='store',
+                        help='Sample gigablast cpu/memory/io/fd usage every N seconds (default: 0, disabled)')
+    parser.add_argument('--gb-cpus', dest='gb_cpus', type=parse_cpu_list, default=None, action='store',
+                        help='Pin gigablast instances to disjoint slices of these cpus (eg. 0-7)')
+    parser.add_argument('--webserver-cpus', dest='ws_cpus', type=parse_cpu_list, default=None, action='store',
+                        help='Pin webserver threads to these cpus (eg. 8-9)')
+    parser.add_argument('--runner-cpus', dest='runner_cpus', type=parse_cpu_list, default=None, action='store',
+                        help='Pin the testcase runner to these cpus (eg. 10)')
+    parser.add_argument('--webserver-engine', dest='ws_engine', default='threads', choices=['threads', 'asyncio'],
+                        help='Serve test pages with a thread per connection or from one asyncio event loop (default: threads)')
+    parser.add_argument('--webserver-keep-alive', dest='ws_keep_alive', action='store_true',
+                        help='Let the webserver keep HTTP/1.1 connections open (testcases can switch it with a keep_alive file)')
+    parser.add_argument('--webserver-idle-timeout', dest='ws_idle_timeout', type=float, default=5.0, action='store',
+                        help='Seconds a kept webserver connection may be idle (default: 5)')
+    parser.add_argument('--synth-config', dest='ws_synth_config', default=None, action='store',
+                        help='Also serve generated sN.synth.<domain> sites configured by this file (see synthetic_sites.py)')
     parser.add_argument('--dest-domain', dest='ws_domain', default='privacore.test', action='store',
                         help='Destination host domain (default: privacore.test)')
     parser.add_argument('--dest-port', dest='ws_port', type=int, default=28080, action='store',
@@ -83,8 +202,15 @@ if __name__ == '__main__':
                         help='Destination host domain (default: privacore.test.key)')
     parser.add_argument('--dest-sslcert', dest='ws_sslcert', default='privacore.test.cert', action='store',
                         help='Destination host domain (default: privacore.test.cert)')
+    parser.add_argument('--dest-tls-protocol', dest='ws_tls_protocol', default='TLSv1', choices=['TLSv1', 'negotiate'],
+                        help='Destination host TLS protocol, TLSv1 only or the newest both sides support (default: TLSv1)')
 
     args = parser.parse_args()
     output_file = 'output-%02d.xml' % args.gb_offset
-    results = main(args.testdir, args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_host, args.gb_port, args.ws_domain, args.ws_port, args.ws_sslport, args.ws_sslkey, args.ws_sslcert, output_file)
+    results = main(args.testdir, args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_host, args.gb_port, args.ws_domain, args.ws_port, args.ws_sslport, args.ws_sslkey, args.ws_sslcert, output_file,
+                   args.gb_max_qps, args.gb_max_inflight, args.gb_clean_workers, args.gb_clean_in_background, args.gb_use_snapshots,
+                   args.gb_warm_pool, args.port_lock_dir, args.gb_ram_path, args.gb_instance_size,
+                   args.resource_interval, args.gb_data_paths, args.gb_merge_scope, args.gb_cpus, args.ws_cpus,
+                   args.runner_cpus, args.ws_engine, args.ws_keep_alive, args.ws_idle_timeout, args.ws_synth_config,
+                   args.ws_tls_protocol)
 
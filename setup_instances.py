@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from gigablast import GigablastInstances
+from gigablast import GigablastInstances, PortAllocator
 import os
 
 
-def main(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port):
-    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port)
+def main(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port, gb_ram_path=None, gb_instance_size=512, gb_data_paths=None,
+         gb_merge_scope='global', port_lock_dir=None):
+    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port, ram_path=gb_ram_path,
+                                      data_paths=gb_data_paths, merge_scope=gb_merge_scope)
+    if port_lock_dir:
+        # claimed the same way run_all_testcases.py does, which claims its own block again when it runs
+        print('Allocated gigablast port %d' % gb_instances.allocate_ports(PortAllocator(port_lock_dir)))
+
+    gb_instances.validate_topology(gb_instance_size * 2**20)
+
     gb_instances.create_instances()
 
 
@@ -27,6 +35,18 @@ if __name__ == '__main__':
                         help='Number of gigablast shards (default: 1)')
     parser.add_argument('--port', dest='gb_port', type=int, default=28000, action='store',
                         help='Gigablast port (default: 28000')
+    parser.add_argument('--ram-path', dest='gb_ram_path', default=None, action='store',
+                        help='Place instance data and merge space in this RAM-backed directory (eg. /dev/shm/gb)')
+    parser.add_argument('--data-path', dest='gb_data_paths', default=None, action='append',
+                        help='Place instance data and merge space in this directory; repeat to stripe instances across disks')
+    parser.add_argument('--merge-scope', dest='gb_merge_scope', default='global', choices=['global', 'shard', 'host'],
+                        help='Share merge space/lock between all hosts on a data path, or give each shard/host its own (default: global)')
+    parser.add_argument('--allocate-ports', dest='port_lock_dir', nargs='?', const='/tmp/pywebtest-ports', action='store',
+                        help='Claim free gigablast ports using lock files in the given directory '
+                             '(default: /tmp/pywebtest-ports) and install hosts.conf with them')
+    parser.add_argument('--instance-size', dest='gb_instance_size', type=int, default=512, action='store',
+                        help='Space in MB needed per instance in --ram-path/--data-path (default: 512)')
 
     args = parser.parse_args()
-    main(args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_port)
+    main(args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_port, args.gb_ram_path, args.gb_instance_size,
+         args.gb_data_paths, args.gb_merge_scope, args.port_lock_dir)
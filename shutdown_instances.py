@@ -4,16 +4,42 @@
 from gigablast import GigablastInstances
 import os
 import subprocess
+import time
 
 
-def main(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port):
-    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port)
+def main(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port, gb_ram_path=None, timeout=60, gb_data_paths=None,
+         gb_merge_scope='global', port_lock_dir=None):
+    gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port, ram_path=gb_ram_path,
+                                      data_paths=gb_data_paths, merge_scope=gb_merge_scope)
     instance_path = gb_instances.get_instance_path(0)
 
-    try:
-        subprocess.call(['./gb', 'stop'], cwd=instance_path, stderr=subprocess.DEVNULL)
-    except subprocess.TimeoutExpired:
-        pass
+    if port_lock_dir:
+        # the run claimed its ports and installed them in hosts.conf
+        allocated_port = gb_instances.load_hostfile_ports()
+        if allocated_port is None:
+            print('Warning: hosts.conf is not for these instances, using port %d' % gb_instances.get_instance_port(0))
+        else:
+            print('Using allocated port %d from hosts.conf' % allocated_port)
+
+    start_time = time.perf_counter()
+    pids = gb_instances.supervisor.find_pids()
+    if not pids:
+        # no process found running from the instance directories, let gb try
+        try:
+            subprocess.call(['./gb', 'stop'], cwd=instance_path, stderr=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            pass
+
+        return
+
+    stop_latencies = gb_instances.supervisor.stop_instances(timeout, pids=pids)
+    for host_id in sorted(pids):
+        if host_id in stop_latencies:
+            print('Instance %d (pid %d) stopped in %.3f seconds' % (host_id, pids[host_id], stop_latencies[host_id]))
+        else:
+            print('Instance %d (pid %d) did not stop' % (host_id, pids[host_id]))
+
+    print('Stopped %d instances in %.3f seconds' % (len(stop_latencies), time.perf_counter() - start_time))
 
 
 if __name__ == '__main__':
@@ -33,6 +59,18 @@ if __name__ == '__main__':
                         help='Number of gigablast shards (default: 1)')
     parser.add_argument('--port', dest='gb_port', type=int, default=28000, action='store',
                         help='Gigablast port (default: 28000')
+    parser.add_argument('--ram-path', dest='gb_ram_path', default=None, action='store',
+                        help='Place instance data and merge space in this RAM-backed directory (eg. /dev/shm/gb)')
+    parser.add_argument('--data-path', dest='gb_data_paths', default=None, action='append',
+                        help='Place instance data and merge space in this directory; repeat to stripe instances across disks')
+    parser.add_argument('--merge-scope', dest='gb_merge_scope', default='global', choices=['global', 'shard', 'host'],
+                        help='Share merge space/lock between all hosts on a data path, or give each shard/host its own (default: global)')
+    parser.add_argument('--allocate-ports', dest='port_lock_dir', nargs='?', const='/tmp/pywebtest-ports', action='store',
+                        help='Gigablast was started with ports claimed in the given lock directory '
+                             '(default: /tmp/pywebtest-ports), stop it on the ports in hosts.conf')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=60, action='store',
+                        help='Seconds to wait for instances to exit before sending SIGTERM/SIGKILL (default: 60)')
 
     args = parser.parse_args()
-    main(args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_port)
+    main(args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_port, args.gb_ram_path, args.timeout,
+         args.gb_data_paths, args.gb_merge_scope, args.port_lock_dir)
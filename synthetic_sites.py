@@ -0,0 +1,170 @@
+import hashlib
+import html
+import itertools
+import random
+
+# host sN.<testset>.<domain> is site N. Page 0 is /, page K is /pK.html
+DEFAULT_CONFIG = {
+    'testset': 'synth',
+    'seed': 1,
+    'sites': 10,
+    'pages': 1000,
+    'fan_out': 10,
+    'external_links': 0.1,
+    'page_size': 4096,
+    'vocabulary': 10000,
+    'zipf': 1.0,
+    'sitemap_size': 10000,
+    'disallow': '',
+}
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'ti', 'so', 'va', 'pe', 'zu', 'an', 'or', 'el', 'is', 'um', 'ob')
+
+
+def read_synth_config(filename):
+    """Read 'key = value' lines, typed like DEFAULT_CONFIG"""
+    config = {}
+    with open(filename, 'r') as file:
+        for line in file.read().splitlines():
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+
+            key, _, value = line.partition('=')
+            key = key.strip()
+            if key not in DEFAULT_CONFIG:
+                raise ValueError('unknown synthetic site setting %s' % key)
+            config[key] = type(DEFAULT_CONFIG[key])(value.strip())
+
+    return config
+
+
+def make_word(index):
+    word = ''
+    while True:
+        word = SYLLABLES[index % len(SYLLABLES)] + word
+        index //= len(SYLLABLES)
+        if index == 0:
+            return word
+
+
+class SyntheticSites:
+    """Deterministically generated sites. Every page, robots.txt and sitemap is computed from the seed and
+    the url, so millions of pages can be crawled without anything on disk"""
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_CONFIG)
+        if config:
+            self.config.update(config)
+
+        self.testset = self.config['testset']
+        self.words = [make_word(i) for i in range(self.config['vocabulary'])]
+        # zipf distributed terms, so some are in every page and most are rare
+        self.cum_weights = list(itertools.accumulate(1.0 / (i + 1) ** self.config['zipf']
+                                                     for i in range(self.config['vocabulary'])))
+
+    def get_random(self, *key):
+        digest = hashlib.sha1(('%s:%s' % (self.config['seed'], ':'.join(str(k) for k in key))).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def get_site(self, server):
+        if not server.startswith('s') or not server[1:].isdigit():
+            return None
+        site = int(server[1:])
+        return site if site < self.config['sites'] else None
+
+    @staticmethod
+    def page_path(page):
+        return '/' if page == 0 else '/p%d.html' % page
+
+    def get_page(self, path):
+        if path == '/':
+            return 0
+        if path.startswith('/p') and path.endswith('.html') and path[2:-5].isdigit() and path[2] != '0':
+            page = int(path[2:-5])
+            if page < self.config['pages']:
+                return page
+        return None
+
+    def respond(self, server, path, origin):
+        """Returns (status code, content type, body), or None if server is not a site.
+        origin(site) gives scheme://host[:port] of a site"""
+        site = self.get_site(server)
+        if site is None:
+            return None
+
+        if path == '/robots.txt':
+            return 200, 'text/plain', self.robots(site, origin)
+
+        if path == '/sitemap.xml' or (path.startswith('/sitemap-') and path.endswith('.xml')):
+            body = self.sitemap(site, path, origin)
+            if body is not None:
+                return 200, 'application/xml', body
+
+        page = self.get_page(path)
+        if page is None:
+            return 404, 'text/html', b'<html><body>404 - not found</body></html>'
+
+        return 200, 'text/html; charset=UTF-8', self.page(site, page, origin)
+
+    def robots(self, site, origin):
+        lines = ['User-agent: *']
+        if self.config['disallow']:
+            lines.append('Disallow: %s' % self.config['disallow'])
+        lines.append('Sitemap: %s/sitemap.xml' % origin(site))
+        return ('\n'.join(lines) + '\n').encode()
+
+    def sitemap(self, site, path, origin):
+        pages = self.config['pages']
+        size = self.config['sitemap_size']
+        num_sitemaps = (pages + size - 1) // size
+
+        if path == '/sitemap.xml' and num_sitemaps > 1:
+            lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                     '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+            for i in range(num_sitemaps):
+                lines.append('<sitemap><loc>%s/sitemap-%d.xml</loc></sitemap>' % (origin(site), i))
+            lines.append('</sitemapindex>')
+            return '\n'.join(lines).encode()
+
+        if path == '/sitemap.xml':
+            index = 0
+        else:
+            index = path[len('/sitemap-'):-len('.xml')]
+            if not index.isdigit() or int(index) >= num_sitemaps:
+                return None
+            index = int(index)
+
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for page in range(index * size, min(pages, (index + 1) * size)):
+            lines.append('<url><loc>%s%s</loc></url>' % (origin(site), self.page_path(page)))
+        lines.append('</urlset>')
+        return '\n'.join(lines).encode()
+
+    def page(self, site, page, origin):
+        rand = self.get_random(site, page)
+        config = self.config
+
+        title = ' '.join(rand.choices(self.words, cum_weights=self.cum_weights, k=4))
+        # about 7 bytes per term
+        terms = rand.choices(self.words, cum_weights=self.cum_weights, k=max(1, config['page_size'] // 7))
+
+        # link to the next page so every page is reachable from the root
+        links = []
+        if page + 1 < config['pages']:
+            links.append(self.page_path(page + 1))
+        for _ in range(config['fan_out']):
+            if config['sites'] > 1 and rand.random() < config['external_links']:
+                links.append(origin(rand.randrange(config['sites'])) + self.page_path(rand.randrange(config['pages'])))
+            else:
+                links.append(self.page_path(rand.randrange(config['pages'])))
+
+        body = ['<html>', '<head><title>%s</title></head>' % html.escape(title), '<body>',
+                '<h1>%s</h1>' % html.escape(title), '<p>%s</p>' % ' '.join(terms), '<ul>']
+        for link in links:
+            body.append('<li><a href="%s">%s</a></li>' % (html.escape(link), html.escape(link)))
+        body.append('</ul>')
+        body.append('</body>')
+        body.append('</html>')
+        return '\n'.join(body).encode()
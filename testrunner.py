@@ -7,8 +7,9 @@ import subprocess
 import requests
 import sys
 import glob
-import shutil
 import ast
+import itertools
+import threading
 from gigablast import GigablastAPI, GigablastInstances, GigablastUtils
 from junit_xml import TestSuite, TestCase
 from urllib.parse import parse_qs
@@ -23,8 +24,145 @@ def print_with_timestamp(func):
 
 print = print_with_timestamp(print)
 
+class ResourceSampler(threading.Thread):
+    """Sample cpu, memory, disk io and open file descriptors of gb instances from /proc"""
+    def __init__(self, gb_instances, interval, output_file):
+        threading.Thread.__init__(self, name='ResourceSampler')
+        self.daemon = True
+
+        self._gb_instances = gb_instances
+        self._interval = interval
+        self._output_file = output_file
+        self._stop_event = threading.Event()
+
+        # (host_id, pid) -> first and last sample
+        self._first = {}
+        self._last = {}
+        self._peak_rss = {}
+        self._peak_fds = {}
+
+        # merge lock path -> number of samples, samples with a lock held, peak locks and peak merge space bytes
+        self._merge_stats = {}
+
+    @staticmethod
+    def read_process(pid):
+        proc_path = '/proc/%d' % pid
+
+        # skip past the command name as it may contain spaces
+        with open(os.path.join(proc_path, 'stat'), 'r') as f:
+            fields = f.read().rpartition(')')[2].split()
+
+        sample = {'cpu_seconds': (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'),
+                  'rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0, 'fds': 0}
+
+        with open(os.path.join(proc_path, 'status'), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    sample['rss_kb'] = int(line.split()[1])
+
+        try:
+            with open(os.path.join(proc_path, 'io'), 'r') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('read_bytes', 'write_bytes'):
+                        sample[key] = int(value)
+
+            sample['fds'] = len(os.listdir(os.path.join(proc_path, 'fd')))
+        except PermissionError:
+            pass
+
+        return sample
+
+    def sample(self, f, elapsed):
+        for host_id, pid in sorted(self._gb_instances.supervisor.find_pids().items()):
+            try:
+                sample = self.read_process(pid)
+            except (FileNotFoundError, ProcessLookupError):
+                # process exited between finding and reading it
+                continue
+
+            key = (host_id, pid)
+            self._first.setdefault(key, sample)
+            self._last[key] = sample
+            self._peak_rss[host_id] = max(self._peak_rss.get(host_id, 0), sample['rss_kb'])
+            self._peak_fds[host_id] = max(self._peak_fds.get(host_id, 0), sample['fds'])
+
+            f.write('%.3f,%d,%d,%.2f,%d,%d,%d,%d\n' %
+                    (elapsed, host_id, pid, sample['cpu_seconds'], sample['rss_kb'],
+                     sample['read_bytes'], sample['write_bytes'], sample['fds']))
+
+    @staticmethod
+    def read_merge_paths(merge_space_path, merge_lock_path):
+        # gb holds a merge lock by creating a file in the lock directory
+        try:
+            num_locks = len(os.listdir(merge_lock_path))
+        except FileNotFoundError:
+            num_locks = 0
+
+        space_bytes = 0
+        for root, dirs, files in os.walk(merge_space_path):
+            for filename in files:
+                try:
+                    space_bytes += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    pass
+
+        return num_locks, space_bytes
+
+    def sample_merge(self, f, elapsed):
+        for merge_space_path, merge_lock_path in self._gb_instances.get_all_merge_paths():
+            num_locks, space_bytes = self.read_merge_paths(merge_space_path, merge_lock_path)
+
+            stats = self._merge_stats.setdefault(merge_lock_path, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += 1 if num_locks else 0
+            stats[2] = max(stats[2], num_locks)
+            stats[3] = max(stats[3], space_bytes)
+
+            f.write('%.3f,%s,%d,%d\n' % (elapsed, merge_lock_path, num_locks, space_bytes))
+
+    def run(self):
+        start_time = time.perf_counter()
+        merge_output_file = os.path.splitext(self._output_file)[0] + '-merge.csv'
+        with open(self._output_file, 'w') as f, open(merge_output_file, 'w') as merge_f:
+            f.write('time,host_id,pid,cpu_seconds,rss_kb,read_bytes,write_bytes,fds\n')
+            merge_f.write('time,merge_lock,locks,merge_space_bytes\n')
+
+            while True:
+                elapsed = time.perf_counter() - start_time
+                self.sample(f, elapsed)
+                self.sample_merge(merge_f, elapsed)
+                if self._stop_event.wait(self._interval):
+                    break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def get_summary(self):
+        summary = {}
+        for (host_id, pid), last in sorted(self._last.items()):
+            first = self._first[(host_id, pid)]
+            prefix = 'gb.%d.' % host_id
+            for key in ('cpu_seconds', 'read_bytes', 'write_bytes'):
+                summary[prefix + key] = summary.get(prefix + key, 0) + (last[key] - first[key])
+
+        for host_id, peak_rss in self._peak_rss.items():
+            summary['gb.%d.peak_rss_kb' % host_id] = peak_rss
+            summary['gb.%d.peak_fds' % host_id] = self._peak_fds[host_id]
+
+        for merge_lock_path, (num_samples, num_locked, peak_locks, peak_space) in self._merge_stats.items():
+            prefix = 'merge.%s.' % merge_lock_path
+            summary[prefix + 'locked_ratio'] = num_locked / num_samples
+            summary[prefix + 'peak_locks'] = peak_locks
+            summary[prefix + 'peak_space_bytes'] = peak_space
+
+        return {key: (('%.2f' % value) if type(value) is float else str(value)) for key, value in sorted(summary.items())}
+
+
 class TestRunner:
-    def __init__(self, testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport):
+    def __init__(self, testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport,
+                 resource_interval=0):
         self.testcase = testcase
         self.testcasedir = os.path.join(testdir, testcase)
         self.testcaseconfigdir = os.path.join(self.testcasedir, 'testcase')
@@ -59,16 +197,41 @@ class TestRunner:
 
         self.testcases = []
 
+        self.resource_interval = resource_interval
+
+        # attached to the junit testsuite
+        self.properties = {}
+
     def run_test(self):
         # verify we have testcase to run
         if os.path.exists(self.testcaseconfigdir):
-            # verify gb has started
-            if self.start_gb():
-                if not self.run_instructions():
-                    self.run_testcase()
+            resource_sampler = None
+            if self.resource_interval > 0:
+                resource_file = 'resources-%02d-%s.csv' % (self.gb_instances.offset, self.testcase)
+                resource_sampler = ResourceSampler(self.gb_instances, self.resource_interval, resource_file)
+                resource_sampler.start()
 
-                # stop & cleanup
-                self.stop_gb()
+            try:
+                # webserver connection handling for this testcase (eg. 'on 2' for keep-alive with 2s idle timeout)
+                keep_alive_args = ' '.join(self.read_file(os.path.join(self.testcaseconfigdir, 'keep_alive'))).split()
+                if keep_alive_args:
+                    self.keep_alive(*keep_alive_args)
+
+                # verify gb has started
+                if self.start_gb():
+                    if not self.run_instructions():
+                        self.run_testcase()
+
+                    # stop & cleanup
+                    self.stop_gb()
+            finally:
+                # the keep_alive file and instruction change the shared webserver, keep it from the next testcase
+                self.webserver.reset_keep_alive()
+
+                # finish the csv even when starting/stopping gb or an instruction fails
+                if resource_sampler:
+                    resource_sampler.stop()
+                    self.properties.update(resource_sampler.get_summary())
 
         return self.get_testsuite()
 
@@ -83,32 +246,79 @@ class TestRunner:
     def format_url(self, url):
         return url.format(DOMAIN=self.ws_domain, PORT=self.ws_port, SSLPORT=self.ws_sslport)
 
+    def requires_restart(self):
+        # installed config files and master/log config survive a collection reset
+        if glob.glob(os.path.join(self.testcaseconfigdir, '*.txt')):
+            return True
+
+        filenames = (glob.glob(os.path.join(self.testcaseconfigdir, 'custom_config*')) +
+                     glob.glob(os.path.join(self.testcaseconfigdir, 'instructions*')))
+        for filename in filenames:
+            for line in self.read_file(filename):
+                tokens = line.split()
+                if 'config_master' in tokens or 'config_log' in tokens:
+                    return True
+
+        return False
+
     def start_gb(self):
+        if self.gb_instances.warm_pool and self.gb_instances.pool_running:
+            if not self.requires_restart():
+                if self.reset_gb():
+                    return True
+            else:
+                self.shutdown_gb()
+
+        return self.cold_start_gb()
+
+    def cold_start_gb(self):
+        cold_start_time = time.perf_counter()
+
         print('Cleaning old data')
 
-        # for each instances
-        for i in range(0, self.gb_instances.num_instances):
-            subprocess.call(['./gbclean.sh'], cwd=self.gb_instances.get_instance_path(i), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # clean all instances concurrently
+        for host_id, elapsed in enumerate(self.gb_instances.clean_instances()):
+            print('Cleaned instance %d in %.3f seconds' % (host_id, elapsed))
 
         self.webserver.clear_served_urls()
+        self.gb_instances.pool_customized = False
 
         print('Copy config files')
+        config_filenames = []
         for filename in glob.glob(os.path.join(self.testcaseconfigdir, '*.txt')):
-            destfile = shutil.copy(filename, self.gb_path)
-            lines = self.read_file(destfile)
-            with open(destfile, 'w') as file:
-                for line in lines:
-                    file.write(self.format_url(line) + '\n')
+            destfile = os.path.join(self.gb_path, os.path.basename(filename))
+            lines = [self.format_url(line) + '\n' for line in self.read_file(filename)]
+
+            # only touch the file when content changes
+            if self.read_file(destfile) != [line[:-1] for line in lines]:
+                with open(destfile, 'w') as file:
+                    file.writelines(lines)
 
-            subprocess.call(['./gb', 'installfile', os.path.basename(filename)], cwd=self.gb_path)
+            config_filenames.append(os.path.basename(filename))
+
+        for filename in sorted(self.gb_instances.install_files(self.gb_path, config_filenames)):
+            print('Installed', filename)
 
         print('Starting gigablast')
         start_time = time.perf_counter()
 
-        subprocess.call(['./gb', 'start'], cwd=self.gb_path, stdout=subprocess.DEVNULL)
+        subprocess.call(self.gb_instances.get_start_command(['./gb', 'start']), cwd=self.gb_path,
+                        stdout=subprocess.DEVNULL)
+
+        # wait until all instances are listening before talking http to them
+        start_latencies = self.gb_instances.supervisor.wait_ready(300)
+        for host_id, latency in sorted(start_latencies.items()):
+            print('Instance %d listening after %.3f seconds' % (host_id, latency))
+
+        # an instance that exited or never listened won't answer http either
+        result = len(start_latencies) == self.gb_instances.num_instances
+        if not result:
+            print('Gigablast failed to start')
+
+        for host_id, cpus in sorted(self.gb_instances.pin_instances().items()):
+            print('Instance %d pinned to cpus %s' % (host_id, ','.join(str(cpu) for cpu in cpus)))
 
         # wait until started
-        result = True
         while result:
             try:
                 # wait until gb is initialized
@@ -129,9 +339,47 @@ class TestRunner:
                     break
                 time.sleep(0.5)
 
+        if result:
+            self.gb_instances.pool_running = True
+            self.gb_instances.cold_start_elapsed = time.perf_counter() - cold_start_time
+
         self.add_testcase('pre', 'start', start_time, not result)
         return result
 
+    def reset_gb(self):
+        print('Resetting gigablast')
+        start_time = time.perf_counter()
+
+        self.webserver.clear_served_urls()
+        self.gb_instances.pool_customized = False
+
+        try:
+            self.api.reset_collection()
+
+            # wait until gb is initialized
+            self.wait_processup()
+
+            self.update_processuptime()
+
+            # set some default/custom config
+            self.config_gb()
+
+            # put some delay after reset
+            time.sleep(1)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            # error status or a body that isn't the expected json as well as a refused connection
+            print('Reset failed, restarting gigablast -', e)
+            # a half reset gb would keep the ports the cold start needs
+            self.shutdown_gb()
+            return False
+
+        saved = self.gb_instances.add_warm_reset(time.perf_counter() - start_time)
+        if saved is not None:
+            print('Reused running gigablast, saved %.3f seconds' % saved)
+
+        self.add_testcase('pre', 'start', start_time)
+        return True
+
     def save_gb(self):
         print('Saving gigablast')
         self.api.save()
@@ -139,12 +387,33 @@ class TestRunner:
         # wait for gb mode to be updated
         time.sleep(0.5)
 
-    def stop_gb(self):
+    def shutdown_gb(self):
         print('Stopping gigablast')
-        self.api.save_and_exit()
+        start_time = time.perf_counter()
 
-        # wait for gb mode to be updated
-        time.sleep(0.5)
+        stop_latencies = self.gb_instances.supervisor.stop_instances()
+        if stop_latencies is not None:
+            for host_id, latency in sorted(stop_latencies.items()):
+                print('Instance %d exited after %.3f seconds' % (host_id, latency))
+            for host_id, pid in sorted(self.gb_instances.supervisor.stop_failures.items()):
+                print('Instance %d (pid %d) did not exit, even after SIGKILL' % (host_id, pid))
+        else:
+            # no instance process found, let gb try
+            self.api.save_and_exit()
+
+            # wait for gb mode to be updated
+            time.sleep(0.5)
+
+        self.gb_instances.pool_running = False
+        self.gb_instances.cold_stop_elapsed = time.perf_counter() - start_time
+
+    def stop_gb(self):
+        # a collection reset keeps collection parameters, so don't hand custom config on to the next testcase
+        if self.gb_instances.warm_pool and not self.requires_restart() and not self.gb_instances.pool_customized:
+            print('Keeping gigablast running')
+            return
+
+        self.shutdown_gb()
 
     def config_gb(self):
         self.api.config_crawldelay(0, 0)
@@ -284,6 +553,7 @@ class TestRunner:
                 convert_func = getattr(self, 'convert_' + token, None)
                 func = getattr(self.api, token, None)
                 if func is not None:
+                    self.gb_instances.pool_customized = True
                     if convert_func is not None:
                         func(convert_func(tokens))
                     else:
@@ -340,6 +610,7 @@ class TestRunner:
         #   - waitingTree spider time is more than an hour
         #   - no pending doleIP
         #   - nothing is being spidered
+        spider_start_time = time.perf_counter()
         for spider_api in self.spider_apis:
             start_time = time.perf_counter()
             check_time = start_time
@@ -393,6 +664,13 @@ class TestRunner:
         for served_url in served_urls:
             print('Spidered ', served_url)
 
+        # indexing throughput, for comparing merge space layouts
+        spider_elapsed = time.perf_counter() - spider_start_time
+        print('Spidered %d urls in %.3f seconds (%.2f urls/s)' %
+              (len(served_urls), spider_elapsed, len(served_urls) / spider_elapsed))
+        self.properties['spider.urls'] = str(len(served_urls))
+        self.properties['spider.seconds'] = '%.3f' % spider_elapsed
+
         return result
 
     def add_testcase(self, test_type, test_item, start_time, failed=False):
@@ -409,7 +687,8 @@ class TestRunner:
         self.testcases.append(testcase)
 
     def get_testsuite(self):
-        return TestSuite(self.testcase, test_cases=self.testcases, package='systemtest')
+        return TestSuite(self.testcase, test_cases=self.testcases, package='systemtest',
+                         properties=self.properties if self.properties else None)
 
     def wait_processup(self):
         for spider_api in self.spider_apis:
@@ -858,13 +1137,17 @@ class TestRunner:
                 results.append(self.format_url(token))
 
             try:
-                response = self.api.search(query, parse_qs(query_param))
+                payload = parse_qs(query_param)
+                page_size = int(payload.pop('n', ['10'])[0])
 
-                failed = (not len(response['results']) == num_results)
-                if not failed:
-                    for index in range(num_results):
-                        url = response['results'][index]['url']
+                # walk the pages until num_results are found, and one more to tell if there are too many
+                search_results = self.api.iter_search(query, payload, page_size, prefetch=(num_results > page_size))
+                urls = [result['url'] for result in itertools.islice(search_results, num_results + 1)]
+                search_results.close()
 
+                failed = (not len(urls) == num_results)
+                if not failed:
+                    for url in urls:
                         # gb doesn't return url with scheme when it's http
                         if not url.startswith('https://'):
                             url = 'http://' + url
@@ -875,7 +1158,7 @@ class TestRunner:
 
                 if failed:
                     print(test_type + ' - ' + query + ' - ' + query_param)
-                    print(response)
+                    print(urls)
 
                 self.add_testcase(test_type, query, start_time, failed)
             except:
@@ -944,6 +1227,13 @@ class TestRunner:
                 print(e)
                 self.add_testcase(test_type, query + ' - ' + query_param, start_time, True)
 
+    def keep_alive(self, *args):
+        # keep_alive [on|off] [idle timeout]
+        enabled = not args or args[0] in ('on', 'true', 'yes', '1')
+        idle_timeout = float(args[1]) if len(args) > 1 else None
+        print('Webserver keep-alive', 'on' if enabled else 'off')
+        self.webserver.set_keep_alive(enabled, idle_timeout)
+
     def verify_spidered(self, *args):
         test_type = 'verify_spidered'
         print('Running test -', test_type)
@@ -955,12 +1245,11 @@ class TestRunner:
             filename = os.path.join(self.testcaseconfigdir, test_type)
             items = self.read_file(filename)
 
-        served_urls = self.webserver.get_served_urls()
         for item in items:
             start_time = time.perf_counter()
             try:
                 url = self.format_url(item)
-                failed = (url not in served_urls)
+                failed = not self.webserver.has_served_url(url)
 
                 if failed:
                     print(test_type + ' - ' + url)
@@ -981,8 +1270,6 @@ class TestRunner:
             items = self.read_file(filename)
 
         if len(items):
-            served_urls = self.webserver.get_served_urls()
-
             start_time = time.perf_counter()
 
             formated_items = []
@@ -990,10 +1277,11 @@ class TestRunner:
                 formated_items.append(self.format_url(item))
 
             for url in formated_items:
-                self.add_testcase(test_type, url, start_time, (url not in served_urls))
+                self.add_testcase(test_type, url, start_time, not self.webserver.has_served_url(url))
 
-            for url in served_urls:
-                if url not in formated_items:
+            formated_set = set(formated_items)
+            for url in self.webserver.ledger.get_urls():
+                if url not in formated_set:
                     self.add_testcase(test_type, url, start_time, True)
 
     def verify_not_spidered(self, *args):
@@ -1007,12 +1295,11 @@ class TestRunner:
             filename = os.path.join(self.testcaseconfigdir, test_type)
             items = self.read_file(filename)
 
-        served_urls = self.webserver.get_served_urls()
         for index, item in enumerate(items):
             start_time = time.perf_counter()
             try:
                 url = self.format_url(item)
-                failed = (url in served_urls)
+                failed = self.webserver.has_served_url(url)
 
                 if failed:
                     print(test_type + ' - ' + url)
@@ -1339,8 +1626,9 @@ class TestRunner:
                 self.add_testcase(test_type, url, start_time, True)
 
 
-def main(testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport):
-    test_runner = TestRunner(testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport)
+def main(testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport, resource_interval=0):
+    test_runner = TestRunner(testdir, testcase, gb_instances, gb_host, webserver, ws_domain, ws_port, ws_sslport,
+                             resource_interval)
     result = test_runner.run_test()
     print(TestSuite.to_xml_string([result]))
 
@@ -1367,6 +1655,26 @@ if __name__ == '__main__':
                         help='Gigablast host (default: 127.0.0.1)')
     parser.add_argument('--port', dest='gb_port', type=int, default=28000, action='store',
                         help='Gigablast port (default: 28000)')
+    parser.add_argument('--max-qps', dest='gb_max_qps', type=float, default=0, action='store',
+                        help='Maximum requests per second sent to each gigablast host (default: 0, unlimited)')
+    parser.add_argument('--max-inflight', dest='gb_max_inflight', type=int, default=0, action='store',
+                        help='Maximum concurrent requests to each gigablast host (default: 0, unlimited)')
+    parser.add_argument('--clean-workers', dest='gb_clean_workers', type=int, default=0, action='store',
+                        help='Number of instances cleaned concurrently (default: 0, all instances)')
+    parser.add_argument('--clean-in-background', dest='gb_clean_in_background', action='store_true',
+                        help='Move instance data aside and delete it in the background')
+    parser.add_argument('--use-snapshots', dest='gb_use_snapshots', action='store_true',
+                        help='Reset instances by cloning a pristine template instead of running gbclean.sh')
+    parser.add_argument('--warm-pool', dest='gb_warm_pool', action='store_true',
+                        help='Keep gigablast running between testcases and reset the collection instead')
+    parser.add_argument('--ram-path', dest='gb_ram_path', default=None, action='store',
+                        help='Place instance data and merge space in this RAM-backed directory (eg. /dev/shm/gb)')
+    parser.add_argument('--data-path', dest='gb_data_paths', default=None, action='append',
+                        help='Place instance data and merge space in this directory; repeat to stripe instances across disks')
+    parser.add_argument('--merge-scope', dest='gb_merge_scope', default='global', choices=['global', 'shard', 'host'],
+                        help='Share merge space/lock between all hosts on a data path, or give each shard/host its own (default: global)')
+    parser.add_argument('--sample-interval', dest='resource_interval', type=float, default=0, action='store',
+                        help='Sample gigablast cpu/memory/io/fd usage every N seconds (default: 0, disabled)')
 
     parser.add_argument('--dest-domain', dest='ws_domain', default='privacore.test', action='store',
                         help='Destination host domain (default: privacore.test)')
@@ -1378,6 +1686,8 @@ if __name__ == '__main__':
                         help='Destination host domain (default: privacore.test.key)')
     parser.add_argument('--dest-sslcert', dest='ws_sslcert', default='privacore.test.cert', action='store',
                         help='Destination host domain (default: privacore.test.cert)')
+    parser.add_argument('--dest-tls-protocol', dest='ws_tls_protocol', default='TLSv1', choices=['TLSv1', 'negotiate'],
+                        help='Destination host TLS protocol, TLSv1 only or the newest both sides support (default: TLSv1)')
 
     pargs = parser.parse_args()
 
@@ -1390,10 +1700,23 @@ if __name__ == '__main__':
         subprocess.call(['./create_ssl_cert.sh', pargs.ws_domain], stdout=subprocess.DEVNULL)
 
     # start webserver
-    test_webserver = TestWebServer(pargs.testdir, pargs.ws_port, pargs.ws_sslport, pargs.ws_sslkey, pargs.ws_sslcert)
+    test_webserver = TestWebServer(pargs.testdir, pargs.ws_port, pargs.ws_sslport, pargs.ws_sslkey, pargs.ws_sslcert,
+                                   tls_protocol=pargs.ws_tls_protocol)
+
+    GigablastAPI.set_governor_limits(pargs.gb_max_qps, pargs.gb_max_inflight)
 
-    gb_instances = GigablastInstances(pargs.gb_offset, pargs.gb_path, pargs.gb_num_instances, pargs.gb_num_shards, pargs.gb_port)
-    main(pargs.testdir, pargs.testcase, gb_instances, pargs.gb_host, test_webserver, pargs.ws_domain, pargs.ws_port, pargs.ws_sslport)
+    gb_instances = GigablastInstances(pargs.gb_offset, pargs.gb_path, pargs.gb_num_instances, pargs.gb_num_shards, pargs.gb_port,
+                                      pargs.gb_clean_workers, pargs.gb_clean_in_background, pargs.gb_use_snapshots,
+                                      pargs.gb_warm_pool, pargs.gb_ram_path, pargs.gb_data_paths, pargs.gb_merge_scope)
+    main(pargs.testdir, pargs.testcase, gb_instances, pargs.gb_host, test_webserver, pargs.ws_domain, pargs.ws_port, pargs.ws_sslport,
+         pargs.resource_interval)
+
+    # stop gigablast left running by the warm pool
+    if gb_instances.pool_running:
+        print('Stopping gigablast')
+        if gb_instances.supervisor.stop_instances() is None:
+            GigablastAPI(pargs.gb_host, gb_instances.get_instance_port(0)).save_and_exit()
+        gb_instances.pool_running = False
 
     # stop webserver
     test_webserver.stop()
@@ -13,10 +13,20 @@ import logging
 import logging.config
 import ssl
 import time
-import cgi
+import html
 import socket
 import struct
-import math
+import string
+import collections
+import gzip
+import zlib
+import random
+import asyncio
+import email.utils
+import http.client
+import io
+
+from synthetic_sites import SyntheticSites, read_synth_config
 
 global logger
 
@@ -35,46 +45,613 @@ def init_mimetypes():
     mimetypes.add_type('text/x-c++src', '.hpp')
 
 
-class Handler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        logger.info("%s" % (format % args))
+# per-file settings in the order they are resolved. content-type and charset defaults are
+# guessed from the file name
+SETTINGS = ('status-code', 'content-type', 'charset', 'content-encoding', 'content-mtu', 'extra-headers',
+            'connection-delay', 'first-byte-delay', 'transfer-rate', 'chunk-jitter', 'stalls')
+
+LISTING_SKIP_ENDINGS = ('.status-code', '.content-type', '.charset', '.content-encoding', '.extra-headers',
+                        '.connection-reset', '.connection-delay', '.content-mtu',
+                        '.first-byte-delay', '.transfer-rate', '.chunk-jitter', '.stalls',
+                        '.revision.1', '.revision.2')
+LISTING_SKIP_FILES = ('README', 'robots.txt', 'default-status-code', 'default-content-type', 'default-charset',
+                      'default-content-encoding', 'default-extra-headers', 'default-connection-delay',
+                      'default-content-mtu', 'default-first-byte-delay', 'default-transfer-rate',
+                      'default-chunk-jitter', 'default-stalls')
+
+# chunk size when shaping a transfer without content-mtu
+SHAPING_CHUNK_SIZE = 4096
+
+# lookup results that are not an entry
+UNKNOWN_TESTSET = 'unknown-testset'
+UNKNOWN_SERVER = 'unknown-server'
+NOT_FOUND = 'not-found'
+
+
+def convert_setting(content, default):
+    if type(default) is int:
+        return int(content)
+    elif type(default) is float:
+        return float(content)
+    elif type(default) is list:
+        return content.split('\n')
+    return content
+
+
+def read_override(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read().decode()
+    except IOError:
+        return ''
+
+
+def resolve_setting(content, default, domain, port, sslport):
+    if '{' in content:
+        try:
+            content = content.format(DOMAIN=domain, PORT=port, SSLPORT=sslport)
+        except KeyError:
+            pass
+        except ValueError:
+            pass
+    return convert_setting(content.strip(), default)
+
+
+def get_revisions(dir_path, filename, names):
+    """N of every filename.revision.N file in dir_path"""
+    prefix = filename + '.revision.'
+    return set(name[len(prefix):] for name in names
+               if name.startswith(prefix) and os.path.isfile(os.path.join(dir_path, name)))
+
+
+class PageEntry:
+    """Response settings for a file with its override files already read"""
+
+    def __init__(self, path, mime_path, names=None):
+        self.path = path
+        dir_path, filename = os.path.split(path)
+        if names is None:
+            names = set(os.listdir(dir_path))
+
+        self.connection_reset = (filename + '.connection-reset') in names
+
+        self.revisions = get_revisions(dir_path, filename, names)
+
+        content_type = "application/octet-stream"
+        mime = mimetypes.guess_type(mime_path, False)
+        if mime[0] is not None:
+            content_type = mime[0]
+        charset = 'UTF-8' if content_type.startswith('text/') else None
+
+        defaults = {'status-code': 200, 'content-type': content_type, 'charset': charset, 'content-encoding': None,
+                    'content-mtu': 0, 'extra-headers': [], 'connection-delay': 0, 'first-byte-delay': 0.0,
+                    'transfer-rate': 0, 'chunk-jitter': 0.0, 'stalls': []}
+
+        self.defaults = defaults
+        self.settings = {}
+        # overrides containing {DOMAIN}/{PORT}/{SSLPORT} (or which don't convert) are resolved per request
+        self.deferred = {}
+        # setting name -> override file. Overrides are counted as served like pages, and the N'th repeat
+        # serves override.revision.N if there is one
+        self.overrides = {}
+        self.override_revisions = {}
+        for name in SETTINGS:
+            default = defaults[name]
+            if (filename + '.' + name) in names:
+                override_path = path + '.' + name
+            elif ('default-' + name) in names:
+                override_path = os.path.join(dir_path, 'default-' + name)
+            else:
+                self.settings[name] = default
+                continue
+
+            self.overrides[name] = override_path
+            revisions = get_revisions(dir_path, os.path.basename(override_path), names)
+            if revisions:
+                self.override_revisions[override_path] = revisions
+            content = read_override(override_path)
+            if '{' in content:
+                self.deferred[name] = (content, default)
+                continue
+            try:
+                self.settings[name] = convert_setting(content.strip(), default)
+            except ValueError:
+                self.deferred[name] = (content, default)
+
+    def get_settings(self, domain, port, sslport):
+        if not self.deferred:
+            return self.settings
+
+        settings = dict(self.settings)
+        for name, (content, default) in self.deferred.items():
+            settings[name] = resolve_setting(content, default, domain, port, sslport)
+        return settings
+
+
+class DirEntry:
+    """Directory without index.html. Served as a listing unless it contains _noindex"""
+
+    def __init__(self, path, names=None):
+        if names is None:
+            names = os.listdir(path)
+        self.noindex = '_noindex' in names
+        self.names = sorted(f for f in names if not f.endswith(LISTING_SKIP_ENDINGS) and f not in LISTING_SKIP_FILES)
+
+
+class TestTreeIndex:
+    """Maps (testset, server, path) to a PageEntry/DirEntry so serving a page is a dictionary lookup.
+    Directories and override files are polled for mtime changes and the index rebuilt when one changes.
+    Anything not in the index is resolved from disk like before"""
+
+    def __init__(self, root_dir, refresh_interval=1.0):
+        self.root_dir = root_dir
+        self.refresh_interval = refresh_interval
+        self.entries = {}
+        self.watched = {}
+        self.num_builds = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.rebuild()
+
+    def start(self):
+        if self.refresh_interval <= 0:
+            return
+        self.thread = threading.Thread(target=self.run, name="TestTreeIndex")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.refresh_interval):
+            if self.is_stale():
+                self.rebuild()
+
+    def is_stale(self):
+        for path, mtime in self.watched.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def rebuild(self):
+        start = time.time()
+        entries = {}
+        watched = {}
+
+        self.watch(watched, self.root_dir)
+        for testset in os.listdir(self.root_dir):
+            testset_dir = os.path.join(self.root_dir, testset)
+            if not os.path.isdir(testset_dir):
+                continue
+            self.watch(watched, testset_dir)
+            for server in os.listdir(testset_dir):
+                server_dir = os.path.join(testset_dir, server)
+                if os.path.isdir(server_dir):
+                    self.index_server(testset, server, server_dir, entries, watched)
+
+        self.entries = entries
+        self.watched = watched
+        self.num_builds += 1
+        logger.info("webserver indexed %d paths in %.3fs" % (len(entries), time.time() - start))
+
+    def watch(self, watched, path):
+        try:
+            watched[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            watched[path] = None
+
+    def index_server(self, testset, server, server_dir, entries, watched):
+        for dir_path, dirnames, filenames in os.walk(server_dir, followlinks=True):
+            # stat before reading so a change made while indexing is picked up by the next poll
+            self.watch(watched, dir_path)
+            rel_path = dir_path[len(server_dir):]
+            names = set(dirnames)
+            names.update(filenames)
+
+            for filename in filenames:
+                entry = PageEntry(os.path.join(dir_path, filename), filename, names)
+                for override_path in entry.overrides.values():
+                    if override_path not in watched:
+                        self.watch(watched, override_path)
+                entries[(testset, server, rel_path + '/' + filename)] = entry
+
+            # directories are keyed with a trailing slash
+            if 'index.html' in names:
+                entry = entries.get((testset, server, rel_path + '/index.html'))
+                if entry is None:
+                    entry = PageEntry(os.path.join(dir_path, 'index.html'), 'index.html', names)
+            else:
+                entry = DirEntry(dir_path, names)
+            entries[(testset, server, rel_path + '/')] = entry
+
+    def lookup(self, testset, server, path):
+        # odd names and paths ('', '..', '//', ...) are left to the filesystem
+        if testset not in ('', '.', '..') and server not in ('', '.', '..') and path.startswith('/') and \
+                '//' not in path and '/./' not in path + '/' and '/../' not in path + '/':
+            entries = self.entries
+            entry = entries.get((testset, server, path))
+            if entry is None and not path.endswith('/'):
+                entry = entries.get((testset, server, path + '/'))
+            if entry is not None:
+                self.num_hits += 1
+                return entry
+
+        self.num_misses += 1
+        return self.lookup_on_disk(testset, server, path)
+
+    def lookup_on_disk(self, testset, server, path):
+        if not os.path.exists(os.path.join(self.root_dir, testset)):
+            return UNKNOWN_TESTSET
+
+        if not os.path.exists(os.path.join(self.root_dir, testset, server)):
+            return UNKNOWN_SERVER
+
+        base_path = os.path.join(self.root_dir, testset, server) + path
+        if os.path.isdir(base_path):
+            if os.path.exists(base_path + '/index.html'):
+                return PageEntry(os.path.join(base_path, 'index.html'), 'index.html')
+            return DirEntry(base_path)
+
+        if not os.path.exists(base_path):
+            return NOT_FOUND
+
+        return PageEntry(base_path, path)
+
+
+TEMPLATE_FIELDS = ('DOMAIN', 'PORT', 'SSLPORT')
+
+
+def compile_template(content, charset):
+    """Split content into encoded literals and field names so that substitution is a join.
+    Returns None if content is served as is (like a failing str.format), or False if it has to go
+    through str.format every time"""
+    try:
+        parsed = list(string.Formatter().parse(content.decode(charset)))
+    except ValueError:
+        return None
+
+    segments = []
+    literals = []
+    unknown_field = False
+    for literal, field, spec, conversion in parsed:
+        if literal:
+            literals.append(literal)
+            segments.append(literal)
+        if field is None:
+            continue
+        if spec or conversion or not field.isidentifier():
+            return False
+        if field not in TEMPLATE_FIELDS:
+            unknown_field = True
+        segments.append(field)
+
+    if unknown_field:
+        return None
+
+    try:
+        segments = [s if s in TEMPLATE_FIELDS else s.encode(charset) for s in segments]
+    except ValueError:
+        return None
+
+    # stateful encodings (BOMs etc.) don't survive being encoded in pieces
+    if b''.join(s for s in segments if type(s) is bytes) != ''.join(literals).encode(charset):
+        return False
+
+    return segments
+
+
+def is_deflated(content):
+    try:
+        zlib.decompress(content)
+        return True
+    except zlib.error:
+        return False
+
+
+# content-encodings applied on the fly: (already encoded?, encode)
+ENCODERS = {'gzip': (lambda content: content[:2] == b'\x1f\x8b', lambda content: gzip.compress(content, mtime=0)),
+            'deflate': (is_deflated, zlib.compress)}
+
+
+class CachedFile:
+    def __init__(self, stamp, content):
+        self.stamp = stamp
+        self.content = content
+        self.has_fields = ord('{') in content
+        self.templates = {}
+        self.encoded = {}
+
+    def get_encoded(self, encoding):
+        """Content compressed with encoding, unless the file already is"""
+        encoded = self.encoded.get(encoding)
+        if encoded is None:
+            is_encoded, encode = ENCODERS[encoding]
+            encoded = self.content if is_encoded(self.content) else encode(self.content)
+            self.encoded[encoding] = encoded
+        return encoded
+
+    def get_template(self, charset):
+        template = self.templates.get(charset)
+        if template is None and charset not in self.templates:
+            template = compile_template(self.content, charset)
+            self.templates[charset] = template
+        return template
+
+
+class ContentCache:
+    """Bounded LRU cache of served files keyed by path (revisions are separate files, so separate keys).
+    Entries are checked against the file's mtime/size so edited files are picked up"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_bytes // 4
+        self.files = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None and cached.stamp == stamp:
+                self.files.move_to_end(path)
+                self.hits += 1
+                self.bytes_saved += len(cached.content)
+                return cached
+
+        with open(path, "rb") as f:
+            cached = CachedFile(stamp, f.read())
+
+        with self.lock:
+            self.misses += 1
+            if self.max_bytes <= 0 or len(cached.content) > self.max_file_bytes:
+                return cached
+
+            old = self.files.pop(path, None)
+            if old is not None:
+                self.size -= len(old.content)
+            self.files[path] = cached
+            self.size += len(cached.content)
+            while self.size > self.max_bytes:
+                _, old = self.files.popitem(last=False)
+                self.size -= len(old.content)
+
+        return cached
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': (self.hits / requests) if requests else 0.0,
+                    'bytes_saved': self.bytes_saved,
+                    'files': len(self.files),
+                    'size': self.size}
+
+
+class RequestLedger:
+    """Thread-safe record of what has been served. Path counts select revisions and are kept for the
+    webserver's lifetime, urls and the fetch log are per testcase (see clear_urls)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path_counts = collections.Counter()
+        self.urls = set()
+        self.log = []
+        self.fetch_times = {}
+        self.host_counts = collections.Counter()
+
+    def count_path(self, path):
+        """Record path as served, returning how many times it was served before"""
+        with self.lock:
+            count = self.path_counts[path]
+            self.path_counts[path] = count + 1
+            return count
+
+    def add_url(self, url):
+        now = time.time()
+        host = urlparse.urlsplit(url).hostname
+        with self.lock:
+            self.urls.add(url)
+            self.log.append((now, url))
+            times = self.fetch_times.get(url)
+            if times is None:
+                self.fetch_times[url] = [now, now]
+            else:
+                times[1] = now
+            self.host_counts[host] += 1
+
+    def clear_urls(self):
+        with self.lock:
+            self.urls = set()
+            self.log = []
+            self.fetch_times = {}
+            self.host_counts = collections.Counter()
+
+    def has_url(self, url):
+        return url in self.urls
+
+    def get_urls(self):
+        """Unique urls in order of first fetch"""
+        with self.lock:
+            return list(self.fetch_times)
+
+    def get_log(self):
+        """(timestamp, url) for every request in order, including repeated fetches"""
+        with self.lock:
+            return list(self.log)
+
+    def get_path_count(self, path):
+        with self.lock:
+            return self.path_counts[path]
+
+    def get_host_count(self, host):
+        with self.lock:
+            return self.host_counts[host]
+
+    def get_host_counts(self):
+        with self.lock:
+            return dict(self.host_counts)
+
+    def get_first_fetch(self, url):
+        with self.lock:
+            times = self.fetch_times.get(url)
+            return times[0] if times else None
+
+    def get_last_fetch(self, url):
+        with self.lock:
+            times = self.fetch_times.get(url)
+            return times[1] if times else None
+
+
+class Response:
+    """A planned response. The engines (Handler for threads, AsyncServer for asyncio) only differ in
+    how they wait for connection_delay and write it"""
+
+    def __init__(self, status_code=200, reason=None):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = []
+        self.body = bytes()
+        self.connection_delay = 0
+        self.content_mtu = 0
+        # transfer shaping: bytes/second, max random seconds between chunks, [(body offset, seconds)]
+        self.transfer_rate = 0
+        self.chunk_jitter = 0.0
+        self.stalls = []
+        self.connection_reset = False
+        # set instead of body when the file is sent straight from disk
+        self.body_path = None
+        self.body_size = 0
+
+    def add_header(self, keyword, value):
+        self.headers.append((keyword, value))
+
+    def get_headers(self, keep_alive, request_version, persistent=False):
+        """Headers to send, with Content-Length and Connection added. persistent is whether the server speaks
+        HTTP/1.1, where clients keep the connection unless told otherwise"""
+        headers = list(self.headers)
+        lengths = [value.strip() for keyword, value in headers if keyword.lower() == 'content-length']
+        length = str(self.body_size if self.body_path else len(self.body))
+        if not lengths:
+            headers.append(('Content-Length', length))
+
+        if keep_alive and not any(keyword.lower() == 'connection' for keyword, _ in headers):
+            if lengths and lengths != [length]:
+                # a fixture with a wrong Content-Length would desync the next request
+                headers.append(('Connection', 'close'))
+            elif request_version == 'HTTP/1.0':
+                headers.append(('Connection', 'keep-alive'))
+        elif persistent and not any(keyword.lower() == 'connection' for keyword, _ in headers):
+            # e.g. the client sent Connection: close
+            headers.append(('Connection', 'close'))
+
+        return headers
+
+    def is_chunked(self):
+        return self.content_mtu > 0 or self.transfer_rate > 0 or self.chunk_jitter > 0 or len(self.stalls) > 0
+
+    def get_schedule(self, head):
+        """(seconds after the first byte, chunk) for head and body"""
+        content = head + self.body
+        chunk_size = self.content_mtu
+        if chunk_size == 0:
+            chunk_size = SHAPING_CHUNK_SIZE
+            if self.transfer_rate > 0:
+                # about 20 writes per second
+                chunk_size = max(512, min(65536, self.transfer_rate // 20))
+
+        stalls = {}
+        for offset, seconds in self.stalls:
+            stalls[len(head) + offset] = stalls.get(len(head) + offset, 0) + seconds
+        ends = set(range(chunk_size, len(content), chunk_size))
+        ends.update(end for end in stalls if 0 < end < len(content))
+        ends.add(len(content))
+
+        # same jitter for the same content, so testcases are repeatable
+        rand = random.Random(zlib.crc32(content))
+        schedule = []
+        at = 0.0
+        start = 0
+        for end in sorted(ends):
+            schedule.append((at, content[start:end]))
+            if self.transfer_rate > 0:
+                at += (end - start) / self.transfer_rate
+            if self.chunk_jitter > 0:
+                at += rand.uniform(0, self.chunk_jitter)
+            at += stalls.get(end, 0)
+            start = end
+        return schedule
+
+
+# smaller files are served from the content cache
+SENDFILE_MIN_SIZE = 64 * 1024
+
+
+def html_response(status_code, body):
+    response = Response(status_code)
+    response.add_header("Content-type", "text/html")
+    response.body = body.encode()
+    return response
+
+
+class Responder:
+    """Works out the response for a request from the tests tree, independent of the engine"""
+
+    def __init__(self, webserver):
+        self.webserver = webserver
+        self.domain = None
+
+    def revision_path(self, path, revisions):
+        """Count path as served and return the file to serve, path.revision.N for the N'th repeat if it exists"""
+        count = self.webserver.ledger.count_path(path)
+        if count > 0 and str(count) in revisions:
+            return path + '.revision.' + str(count)
+        return path
 
     def file_content(self, path, content_type=None, content_encoding=None, charset=None):
         """Return content of file. Empty string for non-existing files"""
-        if not os.path.isfile(path):
-            return bytes()
-
         if charset is None:
             charset = 'utf-8'
 
         if content_type is None:
             content_type = 'text/plain'
 
-        ori_path = path
-        count = self.server.webserver.served_paths.count(ori_path)
-        if count > 0:
-            new_path = path + '.revision.' + str(count)
-
-            if os.path.exists(new_path) and os.path.isfile(new_path):
-                path = new_path
-
-        self.server.webserver.served_paths.append(ori_path)
-
         content = bytes()
         try:
-            with open(path, "rb") as f:
-                content = f.read()
-		#substitute {stuff} in content
-                if content_type.startswith('text/') and content_encoding is None and ord('{') in content:
+            cached = self.webserver.content_cache.get(path)
+            content = cached.content
+            if content_encoding in ENCODERS:
+                content = cached.get_encoded(content_encoding)
+            #substitute {stuff} in content
+            elif content_type.startswith('text/') and content_encoding is None and cached.has_fields:
+                template = cached.get_template(charset)
+                if template is False:
                     try:
                         content = content.decode(charset).format(DOMAIN=self.domain,
-                                                                 PORT=self.server.webserver.port,
-                                                                 SSLPORT=self.server.webserver.sslport).encode(charset)
+                                                                 PORT=self.webserver.port,
+                                                                 SSLPORT=self.webserver.sslport).encode(charset)
                     except KeyError:
                         pass #while testing weird errors served files may not conform to our text replacement syntax
                     except ValueError:
                         pass #while testing weird errors served files may not conform to our text replacement syntax
-                    #content = bytes(content)
+                elif template is not None:
+                    values = {'DOMAIN': self.domain.encode(charset),
+                              'PORT': str(self.webserver.port).encode(charset),
+                              'SSLPORT': str(self.webserver.sslport).encode(charset)}
+                    content = b''.join(values[s] if type(s) is str else s for s in template)
 
         except IOError:
             pass
@@ -84,14 +661,11 @@ class Handler(BaseHTTPRequestHandler):
 
         return content
 
-    def do_GET(self):
-        parsed_url = urlparse.urlparse(self.path)
-        host = self.headers["Host"]
+    def respond(self, request_path, host, isHttp, server_port):
+        parsed_url = urlparse.urlparse(request_path)
         # strip of port from host (eg. www.example.com:80
         host = host.split(':')[0]
 
-        isHttp = (self.server == self.server.webserver.http_server_thread.server)
-
         if isHttp:
             url = "http://"
         else:
@@ -99,12 +673,14 @@ class Handler(BaseHTTPRequestHandler):
 
         url += host.encode('ascii').decode('idna')
 
-        if (isHttp and self.server.server_port != 80) or (not isHttp and self.server.server_port != 443):
-            url += ':' + str(self.server.server_port)
+        port_suffix = ''
+        if (isHttp and server_port != 80) or (not isHttp and server_port != 443):
+            port_suffix = ':' + str(server_port)
+        url += port_suffix
 
-        url += self.path
+        url += request_path
 
-        self.server.webserver.add_served_url(url)
+        self.webserver.add_served_url(url)
 
         # Host is expected to be in the form of <server>.<testcase>.something.....
         if len(host.split('.')) < 2:
@@ -118,105 +694,77 @@ class Handler(BaseHTTPRequestHandler):
         path = parsed_url.path
 
         logger.debug("testset=%s, server=%s, path=%s", testset, server, path)
+        synth = self.webserver.synth
+        if synth is not None and testset == synth.testset:
+            scheme = url.split(':')[0]
+            return self.serve_synthetic_page(synth, server, unescape_path(path),
+                                             lambda site: '%s://s%d.%s.%s%s' % (scheme, site, testset, self.domain,
+                                                                                port_suffix))
+
         return self.serve_page(testset, server, path)
 
+    def serve_synthetic_page(self, synth, server, path, origin):
+        result = synth.respond(server, path, origin)
+        if result is None:
+            return self.respond_unknown_server(server)
+
+        status_code, content_type, body = result
+        response = Response(status_code)
+        response.add_header("Content-type", content_type)
+        response.body = body
+        return response
+
     def respond_unknown_host(self, host):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>Host %s is unknown</body></html>' % host).encode())
+        return html_response(500, '<html><body>Host %s is unknown</body></html>' % host)
 
     def respond_unknown_testset(self, testset):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>testset %s is unknown</body></html>' % testset).encode())
+        return html_response(500, '<html><body>testset %s is unknown</body></html>' % testset)
 
     def respond_unknown_server(self, server):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>server %s is unknown</body></html>' % server).encode())
+        return html_response(500, '<html><body>server %s is unknown</body></html>' % server)
 
     def respond_connection_reset(self):
-        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
-                                struct.pack('ii', 1, 0))
-        self.request.close()
-        return False
-
-    def get_default_setting(self, name, base_path, dir_path, default):
-        file_override_path = base_path + '.' + name
-        default_override_path = os.path.join(dir_path, 'default-' + name)
-
-        override_path = None
-        if os.path.exists(file_override_path):
-            override_path = file_override_path
-        elif os.path.exists(default_override_path):
-            override_path = default_override_path
-
-        value = default
-        if override_path:
-            content = self.file_content(override_path).decode().strip()
-            if type(default) is int:
-                value = int(content)
-            elif type(default) is list:
-                value = content.split('\n')
-            else:
-                value = content
-
-        return value
+        response = Response()
+        response.connection_reset = True
+        return response
 
     def serve_page(self, testset, server, path):
         path = unescape_path(path)
 
-        if not os.path.exists(os.path.join(self.server.webserver.root_dir, testset)):
+        entry = self.webserver.tree_index.lookup(testset, server, path)
+        if entry is UNKNOWN_TESTSET:
             return self.respond_unknown_testset(testset)
 
-        if not os.path.exists(os.path.join(self.server.webserver.root_dir, testset, server)):
+        if entry is UNKNOWN_SERVER:
             return self.respond_unknown_server(server)
 
-        # ok, directory exist so testet and server is known
-        base_path = os.path.join(self.server.webserver.root_dir, testset, server) + path
-        if os.path.isdir(base_path):
-            if os.path.exists(base_path + '/index.html'):
-                base_path = os.path.join(base_path, 'index.html')
-                path = 'index.html'
-            else:
-                return self.maybe_serve_index_page(base_path, path)
-        if not os.path.exists(base_path):
+        # ok, testet and server is known
+        base_path = os.path.join(self.webserver.root_dir, testset, server) + path
+        if entry is NOT_FOUND:
             return self.respond_not_found(base_path)
 
-        if os.path.exists(base_path + ".connection-reset"):
+        if isinstance(entry, DirEntry):
+            return self.maybe_serve_index_page(base_path, path, entry)
+
+        if entry.connection_reset:
             return self.respond_connection_reset()
 
-        # Setup defaults
-        status_code = 200
-        content_type = "application/octet-stream"
-        content_encoding = None
-        content_mtu = 0
-        charset = None
-        extra_headers = []
-        connection_delay = 0
-
-        # try guessing default from mime
-        mime = mimetypes.guess_type(path, False)
-        if mime[0] is not None:
-            content_type = mime[0]
-        if content_type.startswith('text/'):
-            charset = 'UTF-8'
-
-        # look for overrides
-        dir_path = base_path
-        if not os.path.isdir(dir_path):
-            dir_path = os.path.dirname(dir_path)
-
-        status_code = self.get_default_setting('status-code', base_path, dir_path, status_code)
-        content_type = self.get_default_setting('content-type', base_path, dir_path, content_type)
-        charset = self.get_default_setting('charset', base_path, dir_path, charset)
-        content_encoding = self.get_default_setting('content-encoding', base_path, dir_path, content_encoding)
-        content_mtu = self.get_default_setting('content-mtu', base_path, dir_path, content_mtu)
-        extra_headers = self.get_default_setting('extra-headers', base_path, dir_path, extra_headers)
-        connection_delay = self.get_default_setting('connection-delay', base_path, dir_path, connection_delay)
+        settings = entry.get_settings(self.domain, self.webserver.port, self.webserver.sslport)
+        for name, override_path in entry.overrides.items():
+            revision_path = self.revision_path(override_path, entry.override_revisions.get(override_path, ()))
+            if revision_path != override_path:
+                if settings is entry.settings:
+                    settings = dict(settings)
+                settings[name] = resolve_setting(read_override(revision_path), entry.defaults[name], self.domain,
+                                                 self.webserver.port, self.webserver.sslport)
+        status_code = settings['status-code']
+        content_type = settings['content-type']
+        charset = settings['charset']
+        content_encoding = settings['content-encoding']
+        content_mtu = settings['content-mtu']
+        extra_headers = settings['extra-headers']
+        connection_delay = settings['connection-delay']
+        first_byte_delay = settings['first-byte-delay']
 
         if content_type == "":
             content_type = None
@@ -225,86 +773,409 @@ class Handler(BaseHTTPRequestHandler):
         if content_encoding == "":
             content_encoding = None
 
-        if connection_delay > 0:
-            time.sleep(connection_delay)
-
         # ok, got it all
-        self.send_response(status_code)
+        response = Response(status_code)
+        response.connection_delay = connection_delay + first_byte_delay
+        response.content_mtu = content_mtu
+        response.transfer_rate = settings['transfer-rate']
+        response.chunk_jitter = settings['chunk-jitter']
+        for line in settings['stalls']:
+            # <body offset> <seconds>
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                offset, seconds = fields
+                response.stalls.append((int(offset), float(seconds)))
+            except ValueError:
+                logger.warning("ignoring bad stall '%s' for %s" % (line, entry.path))
 
         if content_type is not None:
             if charset is None or charset=="":
-                self.send_header("Content-type", content_type)
+                response.add_header("Content-type", content_type)
             else:
-                self.send_header("Content-type", content_type + "; charset=" + charset)
+                response.add_header("Content-type", content_type + "; charset=" + charset)
 
         if content_encoding:
-            self.send_header("Content-Encoding", content_encoding)
+            response.add_header("Content-Encoding", content_encoding)
 
         for h in extra_headers:
             if ':' in h:
-                self.send_header(h.split(":")[0], h.partition(":")[2])
+                response.add_header(h.split(":")[0], h.partition(":")[2])
 
-        content = self.file_content(base_path, content_type, content_encoding, charset)
-        if content_encoding == 'gzip':
-            # check if content is already gzipped
-            import magic
-            if magic.from_buffer(content, mime=True) != 'application/x-gzip':
-                import gzip
-                content = gzip.compress(content)
+        path = self.revision_path(entry.path, entry.revisions)
 
-        if content_mtu == 0:
+        # files that are sent as they are on disk don't need to be read into memory
+        if self.webserver.use_sendfile and not response.is_chunked() and content_encoding not in ENCODERS and \
+                not ((content_type or 'text/plain').startswith('text/') and content_encoding is None):
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                size = 0
+            if size >= SENDFILE_MIN_SIZE:
+                response.body_path = path
+                response.body_size = size
+                return response
+
+        # gzip/deflate is applied here, and cached with the file
+        response.body = self.file_content(path, content_type, content_encoding, charset)
+        return response
+
+    def maybe_serve_index_page(self, dir, path, entry):
+        if entry.noindex:
+            return Response(404)
+
+        body = ['<html>', '<head>', '<meta charset="UTF-8"/>', '	<title>Contents of %s</title>' % dir, '</head>',
+                '<body>']
+
+        filedir = "" if (path == "/") else path
+        for f in entry.names:
+            body.append('<p><a href="%s/%s">%s</a></p>' % (filedir, html.escape(f, quote=False),
+                                                           html.escape(f, quote=False)))
+
+        body.append('</body>')
+        body.append('</html>')
+        return html_response(200, ''.join(body))
+
+    def respond_not_found(self, path):
+        return html_response(404, '<html><body>404 - %s was not found</body></html>' % path)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Threaded engine: a thread per connection, connection_delay sleeps in it. Shaped responses are
+    handed to the webserver's shaper, see AsyncServer.send_shaped"""
+
+    # headers and body are separate writes, with Nagle a kept connection waits for the delayed ack.
+    # asyncio sets TCP_NODELAY too
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.info("%s" % (format % args))
+
+    def setup(self):
+        # decided per connection, so a testcase switching it doesn't affect open connections
+        if self.server.webserver.keep_alive:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = self.server.webserver.idle_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        isHttp = (self.server == self.server.webserver.http_server_thread.server)
+        response = Responder(self.server.webserver).respond(self.path, self.headers["Host"], isHttp,
+                                                            self.server.server_port)
+        return self.send_planned(response)
+
+    def send_planned(self, response):
+        if response.connection_reset:
+            return self.respond_connection_reset()
+
+        if response.connection_delay > 0:
+            time.sleep(response.connection_delay)
+
+        if response.is_chunked():
+            # the shaper closes the connection after the last chunk
+            self.close_connection = True
+
+        self.send_response(response.status_code, response.reason)
+        for keyword, value in response.get_headers(not self.close_connection, self.request_version,
+                                                 self.protocol_version == 'HTTP/1.1'):
+            self.send_header(keyword, value)
+
+        if response.body_path:
+            self.end_headers()
+            # socket.sendfile falls back to reading and sending for TLS sockets
+            with open(response.body_path, 'rb') as f:
+                self.request.sendfile(f, 0, response.body_size)
+        elif not response.is_chunked():
             self.end_headers()
-            self.wfile.write(content)
+            self.wfile.write(response.body)
         else:
-            content = b''.join(self._headers_buffer) + b'\r\n' + content
-            for i in range(math.ceil(len(content)/content_mtu)):
-                self.wfile.write(content[(i*content_mtu):((i + 1) * content_mtu)])
-                pass
+            head = b''.join(self._headers_buffer) + b'\r\n'
+            self._headers_buffer = []
+            # sleeping through the schedule here would hold this thread for as long as the transfer
+            # takes, the shaper's event loop sends it instead and the server leaves the socket open
+            self.server.handed_over.add(self.request)
+            self.server.webserver.shaper.send_shaped(self.request, response.get_schedule(head))
 
-    def maybe_serve_index_page(self, dir, path):
-        if os.path.exists(dir + "/_noindex"):
-            self.send_response(404)
-            self.end_headers()
+    def respond_connection_reset(self):
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+        self.request.close()
+        self.close_connection = True
+        return False
+
+
+def format_head(response, headers, protocol_version='HTTP/1.0'):
+    """Status line and headers as BaseHTTPRequestHandler writes them"""
+    code = response.status_code
+    reason = response.reason
+    if reason is None:
+        reason = Handler.responses[code][0] if code in Handler.responses else ''
+    lines = ['%s %d %s\r\n' % (protocol_version, code, reason),
+             'Server: %s %s\r\n' % (Handler.server_version, Handler.sys_version),
+             'Date: %s\r\n' % email.utils.formatdate(usegmt=True)]
+    for keyword, value in headers:
+        lines.append('%s: %s\r\n' % (keyword, value))
+    lines.append('\r\n')
+    return ''.join(lines).encode('latin-1', 'strict')
+
+
+def error_response(code, message=None):
+    """Like BaseHTTPRequestHandler.send_error"""
+    short, explain = Handler.responses.get(code, ('???', '???'))
+    if message is None:
+        message = short
+    body = Handler.error_message_format % {'code': code,
+                                           'message': html.escape(message, quote=False),
+                                           'explain': html.escape(explain, quote=False)}
+    response = Response(code, message)
+    response.body = body.encode('UTF-8', 'replace')
+    response.add_header('Connection', 'close')
+    response.add_header('Content-Type', Handler.error_content_type)
+    response.add_header('Content-Length', str(len(response.body)))
+    return response
+
+
+class AsyncServer(threading.Thread):
+    """asyncio engine: one thread runs an event loop serving both http and https. connection_delay
+    doesn't hold a thread, so slow testcases and large crawls don't need a thread per connection.
+    Without a port it listens on nothing and only sends what the threaded engine hands over"""
+
+    def __init__(self, webserver, port, sslport=None, ssl_context=None):
+        threading.Thread.__init__(self, name="AsyncServer")
+        self.daemon = True
+        self.webserver = webserver
+        self.port = port
+        self.sslport = sslport
+        self.ssl_context = ssl_context
+        self.loop = asyncio.new_event_loop()
+        self.servers = []
+        self.started = threading.Event()
+        self.error = None
+        self.num_connections = 0
+        self.max_connections = 0
+
+    def run(self):
+        if self.webserver.cpus:
+            os.sched_setaffinity(0, self.webserver.cpus)
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.start_servers())
+        except Exception as e:
+            self.error = e
+            self.started.set()
             return
+        self.started.set()
 
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-
-        self.wfile.write('<html>'.encode())
-        self.wfile.write('<head>'.encode())
-        self.wfile.write('<meta charset="UTF-8"/>'.encode())
-        self.wfile.write(('	<title>Contents of %s</title>' % dir).encode())
-        self.wfile.write('</head>'.encode())
-        self.wfile.write('<body>'.encode())
-
-        l = os.listdir(dir)
-        l.sort()
-
-        special_ending = ('.status-code', '.content-type', '.charset', '.content-encoding', '.extra-headers',
-                          '.connection-reset', '.connection-delay', '.content-mtu',
-                          '.revision.1', '.revision.2')
-        special_file = ('README', 'robots.txt', 'default-status-code', 'default-content-type', 'default-charset',
-                        'default-content-encoding', 'default-extra-headers', 'default-connection-delay',
-                        'default-content-mtu')
-        filedir = "" if (path == "/") else path
-        for f in l:
-            if not f.endswith(special_ending) and f not in special_file:
-                self.wfile.write(('<p><a href="%s/%s">%s</a></p>' % (filedir, cgi.escape(f), cgi.escape(f))).encode())
+        self.loop.run_forever()
 
-        self.wfile.write('</body>'.encode())
-        self.wfile.write('</html>'.encode())
+        for server in self.servers:
+            server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
 
-    def respond_not_found(self, path):
-        self.send_response(404)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>404 - %s was not found</body></html>' % path).encode())
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(10)
+
+    async def start_servers(self):
+        if self.port is None:
+            return
+        self.servers.append(await asyncio.start_server(lambda r, w: self.handle(r, w, True, self.port),
+                                                       '0.0.0.0', self.port, backlog=128))
+        if self.ssl_context is not None:
+            self.servers.append(await asyncio.start_server(lambda r, w: self.handle(r, w, False, self.sslport),
+                                                           '0.0.0.0', self.sslport, backlog=128,
+                                                           ssl=self.ssl_context))
+
+    async def handle(self, reader, writer, isHttp, server_port):
+        self.num_connections += 1
+        self.max_connections = max(self.max_connections, self.num_connections)
+        # decided per connection, like the threaded engine
+        keep_alive = self.webserver.keep_alive
+        idle_timeout = self.webserver.idle_timeout
+        try:
+            while await self.handle_request(reader, writer, isHttp, server_port, keep_alive, idle_timeout):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        except Exception:
+            logger.exception("error handling request")
+        finally:
+            self.num_connections -= 1
+            if not writer.transport.is_closing():
+                writer.close()
+
+    async def read_line(self, reader):
+        try:
+            return await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError:
+            return None
+
+    async def handle_request(self, reader, writer, isHttp, server_port, keep_alive, idle_timeout):
+        """Serve one request. Returns True if the connection is kept for another"""
+        if keep_alive:
+            try:
+                requestline = await asyncio.wait_for(self.read_line(reader), idle_timeout)
+            except asyncio.TimeoutError:
+                return False
+        else:
+            requestline = await self.read_line(reader)
+        if requestline is None:
+            return await self.send(writer, error_response(414), '')
+        if not requestline:
+            return False
+
+        requestline = str(requestline, 'iso-8859-1').rstrip('\r\n')
+        words = requestline.split()
+        try:
+            if len(words) != 3 or not words[2].startswith('HTTP/'):
+                raise ValueError
+            command, path, version = words
+            version_number = tuple(int(n) for n in version.split('/', 1)[1].split('.'))
+            if len(version_number) != 2:
+                raise ValueError
+        except ValueError:
+            return await self.send(writer, error_response(400, "Bad request syntax (%r)" % requestline), requestline)
+
+        header_lines = []
+        while True:
+            line = await self.read_line(reader)
+            if line is None:
+                return await self.send(writer, error_response(431, "Line too long"), requestline)
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(header_lines) > http.client._MAXHEADERS:
+                return await self.send(writer, error_response(431, "Too many headers"), requestline)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+        if command != 'GET':
+            return await self.send(writer, error_response(501, "Unsupported method (%r)" % command), requestline)
+
+        # same rules as BaseHTTPRequestHandler.parse_request
+        conntype = headers.get('Connection', '').lower()
+        if conntype == 'close':
+            keep_alive = False
+        elif conntype != 'keep-alive' and version_number < (1, 1):
+            keep_alive = False
+
+        # same as BaseHTTPRequestHandler, '//' would be taken for a host
+        if path.startswith('//'):
+            path = '/' + path.lstrip('/')
+
+        response = Responder(self.webserver).respond(path, headers["Host"], isHttp, server_port)
+        return await self.send(writer, response, requestline, keep_alive, version)
+
+    async def send(self, writer, response, requestline, keep_alive=False, request_version='HTTP/1.0'):
+        if response.connection_reset:
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            writer.transport.abort()
+            return False
+
+        if response.connection_delay > 0:
+            await asyncio.sleep(response.connection_delay)
+
+        logger.info('"%s" %s -' % (requestline, response.status_code))
+
+        protocol_version = 'HTTP/1.1' if self.webserver.keep_alive else 'HTTP/1.0'
+        headers = response.get_headers(keep_alive, request_version, protocol_version == 'HTTP/1.1')
+        if ('connection', 'close') in ((keyword.lower(), value.strip().lower()) for keyword, value in headers):
+            keep_alive = False
+
+        head = format_head(response, headers, protocol_version)
+        if response.body_path:
+            writer.write(head)
+            await writer.drain()
+            # loop.sendfile falls back to reading and writing for TLS transports
+            with open(response.body_path, 'rb') as f:
+                await self.loop.sendfile(writer.transport, f, 0, response.body_size)
+        elif not response.is_chunked():
+            writer.write(head + response.body)
+        else:
+            # write the chunks one by one instead of letting the transport join them. Not for TLS, where
+            # a zero limit leaves drain() waiting forever, and chunks are sent as separate records anyway
+            tls = writer.get_extra_info('sslcontext') is not None
+            if not tls:
+                writer.transport.set_write_buffer_limits(0)
+            start_time = self.loop.time()
+            for at, chunk in response.get_schedule(head):
+                wait = start_time + at - self.loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                writer.write(chunk)
+                await writer.drain()
+            if not tls:
+                writer.transport.set_write_buffer_limits()
+        await writer.drain()
+
+        return keep_alive
+
+    def send_shaped(self, sock, schedule):
+        """Send schedule (see Response.get_schedule) on a connected socket of the threaded engine
+        and close it. Called from the handler thread"""
+        sock.setblocking(False)
+        asyncio.run_coroutine_threadsafe(self.send_schedule(sock, schedule), self.loop)
+
+    async def send_schedule(self, sock, schedule):
+        try:
+            start_time = self.loop.time()
+            for at, chunk in schedule:
+                wait = start_time + at - self.loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self.sock_write(sock, chunk)
+        except (ConnectionError, ssl.SSLError):
+            pass
+        except Exception:
+            logger.exception("error sending shaped response")
+        finally:
+            # same as socketserver's shutdown_request
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            sock.close()
+
+    async def sock_write(self, sock, data):
+        # loop.sock_sendall doesn't take ssl sockets, so wait for the socket to be writable ourselves
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[sock.send(view):]
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                writable = self.loop.create_future()
+
+                def set_writable():
+                    if not writable.done():
+                        writable.set_result(None)
+
+                self.loop.add_writer(sock.fileno(), set_writable)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(sock.fileno())
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
-    pass
+
+    def __init__(self, server_address, RequestHandlerClass):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        # sockets of shaped responses, closed by the shaper instead
+        self.handed_over = set()
+
+    def shutdown_request(self, request):
+        if request in self.handed_over:
+            self.handed_over.discard(request)
+            return
+        HTTPServer.shutdown_request(self, request)
 
 
 class ServerThread(threading.Thread):
@@ -314,11 +1185,17 @@ class ServerThread(threading.Thread):
         self.server.webserver = webserver
 
     def run(self):
+        # request threads are started from here and inherit the affinity
+        if self.server.webserver.cpus:
+            os.sched_setaffinity(0, self.server.webserver.cpus)
+
         self.server.serve_forever()
 
 
 class TestWebServer:
-    def __init__(self, root_dir="tests", port=8080, sslport=4443, keyfile=None, certfile=None, loggingconf='logging.conf'):
+    def __init__(self, root_dir="tests", port=8080, sslport=4443, keyfile=None, certfile=None, loggingconf='logging.conf',
+                 cpus=None, index_interval=1.0, cache_size=64 * 1024 * 1024, engine='threads', keep_alive=False,
+                 idle_timeout=5.0, use_sendfile=True, synth_config=None, tls_protocol='TLSv1'):
         # try from working dir, else from script dir
         if os.path.exists(loggingconf):
             logging.config.fileConfig(loggingconf)
@@ -327,18 +1204,37 @@ class TestWebServer:
 
         global logger
         logger = logging.getLogger(__name__)
-        logger.info("webserver initializing with port=%d sslport=%d" % (port, sslport))
+        logger.info("webserver initializing with port=%d sslport=%d engine=%s" % (port, sslport, engine))
 
         init_mimetypes()
 
         self.root_dir = root_dir
         self.port = port
         self.sslport = sslport
+        self.cpus = cpus
+        self.engine = engine
+        # HTTP/1.1 persistent connections, can be switched per testcase
+        self.default_keep_alive = keep_alive
+        self.default_idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
         self.http_server_thread = None
         self.https_server_thread = None
-        self.served_urls = []
-        self.served_paths = []
+        self.async_server = None
+        self.shaper = None
+        self.ledger = RequestLedger()
+
+        # index of the tests tree, rebuilt when something changes (index_interval=0 disables polling)
+        self.tree_index = TestTreeIndex(root_dir, index_interval)
+        self.tree_index.start()
+
+        self.content_cache = ContentCache(cache_size)
+        self.use_sendfile = use_sendfile
 
+        # generated sN.synth.<domain> sites, see synthetic_sites.py
+        self.synth = SyntheticSites(synth_config) if synth_config is not None else None
+
+        ctx = None
         if keyfile is not None and certfile is not None:
             logger.info("webserver (https) initializing")
 
@@ -353,20 +1249,37 @@ class TestWebServer:
                 if server_name is None:
                     return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
 
-            httpsd = ThreadedHTTPServer(("", sslport), Handler)
-            ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            if tls_protocol == 'negotiate':
+                # let the client pick, down to TLSv1 where the openssl security level allows it
+                ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                ctx.minimum_version = ssl.TLSVersion.TLSv1
+            else:
+                ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
             ctx.load_cert_chain(certfile, keyfile)
             ctx.set_servername_callback(servername_callback)
 
-            httpsd.socket = ctx.wrap_socket(httpsd.socket, server_side=True)
-            self.https_server_thread = ServerThread(httpsd, self)
-            self.https_server_thread.daemon = True
-            self.https_server_thread.start()
-
-        httpd = ThreadedHTTPServer(("", port), Handler)
-        self.http_server_thread = ServerThread(httpd, self)
-        self.http_server_thread.daemon = True
-        self.http_server_thread.start()
+        if engine == 'asyncio':
+            self.async_server = AsyncServer(self, port, sslport if ctx else None, ctx)
+            self.async_server.start()
+            self.async_server.started.wait()
+            if self.async_server.error:
+                raise self.async_server.error
+        else:
+            # an event loop for shaped responses, so they don't sleep in request threads
+            self.shaper = AsyncServer(self, None)
+            self.shaper.start()
+            self.shaper.started.wait()
+            if ctx:
+                httpsd = ThreadedHTTPServer(("", sslport), Handler)
+                httpsd.socket = ctx.wrap_socket(httpsd.socket, server_side=True)
+                self.https_server_thread = ServerThread(httpsd, self)
+                self.https_server_thread.daemon = True
+                self.https_server_thread.start()
+
+            httpd = ThreadedHTTPServer(("", port), Handler)
+            self.http_server_thread = ServerThread(httpd, self)
+            self.http_server_thread.daemon = True
+            self.http_server_thread.start()
 
         logger.info("webserver initialized")
 
@@ -375,20 +1288,46 @@ class TestWebServer:
 
         if self.http_server_thread:
             self.http_server_thread.server.shutdown()
+            self.http_server_thread.server.server_close()
 
         if self.https_server_thread:
             self.https_server_thread.server.shutdown()
+            self.https_server_thread.server.server_close()
+
+        if self.async_server:
+            self.async_server.stop()
+
+        if self.shaper:
+            self.shaper.stop()
+
+        self.tree_index.stop()
 
         logger.info("webserver stopped")
 
+    def set_keep_alive(self, keep_alive, idle_timeout=None):
+        """Applies to connections accepted from now on"""
+        self.keep_alive = keep_alive
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        logger.info("webserver keep_alive=%s idle_timeout=%.1f" % (self.keep_alive, self.idle_timeout))
+
+    def reset_keep_alive(self):
+        self.set_keep_alive(self.default_keep_alive, self.default_idle_timeout)
+
     def add_served_url(self, url):
-        self.served_urls.append(url)
+        self.ledger.add_url(url)
 
     def get_served_urls(self):
-        return self.served_urls
+        return [url for _, url in self.ledger.get_log()]
+
+    def has_served_url(self, url):
+        return self.ledger.has_url(url)
 
     def clear_served_urls(self):
-        self.served_urls = []
+        self.ledger.clear_urls()
+
+    def get_cache_stats(self):
+        return self.content_cache.get_stats()
 
 
 if __name__ == '__main__':
@@ -398,10 +1337,29 @@ if __name__ == '__main__':
     parser.add_argument("--sslport", type=int, help="HTTPS server port number (default: 4443)", default=4443)
     parser.add_argument("--keyfile", type=str, help="SSL key file (.key)")
     parser.add_argument("--certfile", type=str, help="SSL certificate file (.cert)")
+    parser.add_argument("--tls-protocol", choices=['TLSv1', 'negotiate'], default='TLSv1',
+                        help="Serve https with TLSv1 only or negotiate the newest version (default: TLSv1)")
     parser.add_argument("--loggingconf", type=str, default="logging.conf")
+    parser.add_argument("--index-interval", type=float, default=1.0,
+                        help="Seconds between checks for changes in the root directory (0 disables)")
+    parser.add_argument("--cache-size", type=int, default=64 * 1024 * 1024,
+                        help="Bytes of file content to keep in memory (0 disables)")
+    parser.add_argument("--engine", choices=['threads', 'asyncio'], default='threads',
+                        help="Thread per connection or a single asyncio event loop (default: threads)")
+    parser.add_argument("--keep-alive", action='store_true', help="Allow HTTP/1.1 persistent connections")
+    parser.add_argument("--no-sendfile", dest='use_sendfile', action='store_false',
+                        help="Read large static files into memory instead of using sendfile")
+    parser.add_argument("--synth-config", type=str, default=None,
+                        help="Serve generated sN.synth.<domain> sites configured by this file")
+    parser.add_argument("--idle-timeout", type=float, default=5.0,
+                        help="Seconds a persistent connection may be idle (default: 5)")
     args = parser.parse_args()
 
-    test_webserver = TestWebServer(args.rootdir, args.port, args.sslport, args.keyfile, args.certfile, args.loggingconf)
+    test_webserver = TestWebServer(args.rootdir, args.port, args.sslport, args.keyfile, args.certfile, args.loggingconf,
+                                   index_interval=args.index_interval, cache_size=args.cache_size,
+                                   engine=args.engine, keep_alive=args.keep_alive, idle_timeout=args.idle_timeout,
+                                   use_sendfile=args.use_sendfile, tls_protocol=args.tls_protocol,
+                                   synth_config=read_synth_config(args.synth_config) if args.synth_config else None)
 
     time.sleep(10 * 356 * 84100)
 
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+# Benchmark the test webserver engines against each other
+
+import argparse
+import asyncio
+import http.client
+import os
+import resource
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from webserver import TestWebServer
+
+
+def create_bench_root(root_dir, delay, large_size):
+    server_dir = os.path.join(root_dir, 'bench', 's1')
+    os.makedirs(server_dir, exist_ok=True)
+
+    with open(os.path.join(server_dir, 'slow.html'), 'w') as f:
+        f.write('<html><body>slow</body></html>\n')
+    with open(os.path.join(server_dir, 'slow.html.connection-delay'), 'w') as f:
+        f.write('%d\n' % delay)
+
+    # binary, so it can be sent with sendfile
+    with open(os.path.join(server_dir, 'large.bin'), 'wb') as f:
+        for _ in range(large_size):
+            f.write(os.urandom(2**20))
+
+    # one file per response type of the requests benchmark, about 4KB each
+    paragraphs = ''.join('<p>paragraph %d of some static text</p>\n' % i for i in range(100))
+    links = ''.join('<a href="http://s%d.bench.{DOMAIN}:{PORT}/">s%d</a>\n' % (i, i) for i in range(20))
+    for filename, content in (('static.html', paragraphs), ('templated.html', links + paragraphs[:2500]),
+                              ('gzip.html', paragraphs), ('mtu.html', paragraphs)):
+        with open(os.path.join(server_dir, filename), 'w') as f:
+            f.write('<html><body>\n%s</body></html>\n' % content)
+    with open(os.path.join(server_dir, 'gzip.html.content-encoding'), 'w') as f:
+        f.write('gzip\n')
+    with open(os.path.join(server_dir, 'mtu.html.content-mtu'), 'w') as f:
+        f.write('512\n')
+
+    os.makedirs(os.path.join(server_dir, 'dir'), exist_ok=True)
+    for i in range(50):
+        with open(os.path.join(server_dir, 'dir', 'f%d.html' % i), 'w') as f:
+            f.write('<html><body>%d</body></html>\n' % i)
+
+
+async def fetch(port, host, path):
+    start_time = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode())
+    data = await reader.read()
+    writer.close()
+    return time.perf_counter() - start_time, data.startswith(b'HTTP/1.0 200')
+
+
+async def run_clients(port, host, path, connections, timeout):
+    return await asyncio.gather(*[asyncio.wait_for(fetch(port, host, path), timeout) for _ in range(connections)],
+                                return_exceptions=True)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_capacity(engine, root_dir, port, connections, timeout, loggingconf):
+    """Open connections concurrently against a page with a connection-delay and see how many complete"""
+    webserver = TestWebServer(root_dir, port, port + 1, loggingconf=loggingconf, index_interval=0, engine=engine)
+
+    peak_threads = [threading.active_count()]
+    stop_event = threading.Event()
+
+    def sample_threads():
+        while not stop_event.wait(0.05):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+
+    start_time = time.perf_counter()
+    results = asyncio.run(run_clients(port, 's1.bench.localhost', '/slow.html', connections, timeout))
+    elapsed = time.perf_counter() - start_time
+
+    stop_event.set()
+    sampler.join()
+    webserver.stop()
+
+    latencies = sorted(r[0] for r in results if isinstance(r, tuple) and r[1])
+    failed = connections - len(latencies)
+    print('%-8s %6d connections: %6d ok %6d failed in %7.3fs, peak %5d threads, latency p50=%.3fs p99=%.3fs '
+          'max=%.3fs' % (engine, connections, len(latencies), failed, elapsed, peak_threads[0],
+                         percentile(latencies, 50), percentile(latencies, 99), percentile(latencies, 100)))
+
+
+def download(port, host, path, requests):
+    """Fetch path sequentially, returning the number of bytes received"""
+    received = 0
+    buf = bytearray(2**20)
+    for _ in range(requests):
+        with socket.create_connection(('127.0.0.1', port)) as s:
+            s.sendall(('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode())
+            while True:
+                n = s.recv_into(buf)
+                if not n:
+                    break
+                received += n
+    return received
+
+
+def bench_throughput(engine, root_dir, port, clients, requests, use_sendfile, loggingconf):
+    """Download a multi-megabyte file with a number of concurrent clients"""
+    webserver = TestWebServer(root_dir, port, port + 1, loggingconf=loggingconf, index_interval=0, engine=engine,
+                              use_sendfile=use_sendfile)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        received = sum(executor.map(lambda _: download(port, 's1.bench.localhost', '/large.bin', requests),
+                                    range(clients)))
+    elapsed = time.perf_counter() - start_time
+
+    webserver.stop()
+
+    print('%-8s sendfile=%-5s %4d downloads: %9.1f MB in %7.3fs, %8.1f MB/s' %
+          (engine, use_sendfile, clients * requests, received / 2**20, elapsed, received / 2**20 / elapsed))
+
+
+# response types measured by the requests benchmark
+SCENARIOS = (('static', '/static.html'),
+             ('templated', '/templated.html'),
+             ('gzip', '/gzip.html'),
+             ('mtu', '/mtu.html'),
+             ('index', '/dir/'))
+
+
+def make_connection(scheme, host, port, ssl_context):
+    if scheme == 'https':
+        conn = http.client.HTTPSConnection(host, port, context=ssl_context)
+    else:
+        conn = http.client.HTTPConnection(host, port)
+
+    # connect to localhost, but keep the test host for the Host header and SNI
+    conn._create_connection = lambda address, *args: socket.create_connection(('127.0.0.1', port), *args)
+    return conn
+
+
+def run_client(scheme, host, port, path, requests, keep_alive, ssl_context):
+    """Returns latencies of successful requests and the number of failed ones"""
+    latencies = []
+    errors = 0
+    conn = None
+    for _ in range(requests):
+        start_time = time.perf_counter()
+        try:
+            if conn is None:
+                conn = make_connection(scheme, host, port, ssl_context)
+            conn.request('GET', path, headers={} if keep_alive else {'Connection': 'close'})
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                errors += 1
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if conn:
+                conn.close()
+            conn = None
+
+    if conn:
+        conn.close()
+    return latencies, errors
+
+
+def bench_requests(engine, root_dir, port, domain, keyfile, certfile, clients, requests, loggingconf,
+                   tls_protocol='TLSv1'):
+    """Requests/s and latency for each response type, with and without keep-alive, over http and https"""
+    webserver = TestWebServer(root_dir, port, port + 1, keyfile, certfile, loggingconf=loggingconf, index_interval=0,
+                              engine=engine, keep_alive=True, tls_protocol=tls_protocol)
+
+    # offer TLSv1 too, as the test server only speaks TLSv1 unless told to negotiate
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1
+    ssl_context.set_ciphers('DEFAULT:@SECLEVEL=0')
+
+    host = 's1.bench.' + domain
+    schemes = [('http', port)]
+    if keyfile and certfile:
+        schemes.append(('https', port + 1))
+
+    for scheme, scheme_port in schemes:
+        for keep_alive in (True, False):
+            for scenario, path in SCENARIOS:
+                start_time = time.perf_counter()
+                with ThreadPoolExecutor(clients) as executor:
+                    results = list(executor.map(lambda _: run_client(scheme, host, scheme_port, path, requests,
+                                                                     keep_alive, ssl_context),
+                                                range(clients)))
+                elapsed = time.perf_counter() - start_time
+
+                latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+                errors = sum(client_errors for _, client_errors in results)
+                print('%-8s %-5s keep-alive=%-5s %-9s %8.1f req/s  p50=%6.2fms p90=%6.2fms p99=%6.2fms  '
+                      'errors=%d' % (engine, scheme, keep_alive, scenario, len(latencies) / elapsed,
+                                     percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+                                     percentile(latencies, 99) * 1000, errors))
+
+    webserver.stop()
+
+
+def main(benches, engines, port, connections, delay, timeout, loggingconf, large_size, clients, requests, domain,
+         keyfile, certfile, request_clients, request_count, tls_protocol='TLSv1'):
+    # every connection is a file descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    root_dir = tempfile.mkdtemp(prefix='webserver_bench.')
+    try:
+        create_bench_root(root_dir, delay, large_size)
+
+        if 'requests' in benches:
+            print('Requests: %d clients doing %d requests each per response type' % (request_clients, request_count))
+            for engine in engines:
+                bench_requests(engine, root_dir, port, domain, keyfile, certfile, request_clients, request_count,
+                               loggingconf, tls_protocol)
+
+        if 'capacity' in benches:
+            print('Capacity: %d concurrent connections to a page with %d second connection-delay' %
+                  (connections, delay))
+            for engine in engines:
+                bench_capacity(engine, root_dir, port, connections, timeout, loggingconf)
+
+        if 'throughput' in benches:
+            print('Throughput: %d clients downloading a %d MB file %d times each' % (clients, large_size, requests))
+            for engine in engines:
+                for use_sendfile in (False, True):
+                    bench_throughput(engine, root_dir, port, clients, requests, use_sendfile, loggingconf)
+    finally:
+        shutil.rmtree(root_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', dest='benches', action='append', choices=['requests', 'capacity', 'throughput'],
+                        help='Benchmark to run, can be repeated (default: all)')
+    parser.add_argument('--engine', dest='engines', action='append', choices=['threads', 'asyncio'],
+                        help='Engine to benchmark, can be repeated (default: both)')
+    parser.add_argument('-p', '--port', type=int, default=28080, action='store',
+                        help='Webserver port (default: 28080)')
+    parser.add_argument('-c', '--connections', type=int, default=1000, action='store',
+                        help='Concurrent connections (default: 1000)')
+    parser.add_argument('--delay', type=int, default=2, action='store',
+                        help='connection-delay of the page in seconds (default: 2)')
+    parser.add_argument('--timeout', type=float, default=60, action='store',
+                        help='Seconds before a connection counts as failed (default: 60)')
+    parser.add_argument('--large-size', type=int, default=32, action='store',
+                        help='Size of the file downloaded in the throughput test in MB (default: 32)')
+    parser.add_argument('--clients', type=int, default=4, action='store',
+                        help='Concurrent clients in the throughput test (default: 4)')
+    parser.add_argument('--requests', type=int, default=8, action='store',
+                        help='Downloads per client in the throughput test (default: 8)')
+    parser.add_argument('--request-clients', type=int, default=8, action='store',
+                        help='Concurrent clients in the requests test (default: 8)')
+    parser.add_argument('--request-count', type=int, default=200, action='store',
+                        help='Requests per client and response type in the requests test (default: 200)')
+    parser.add_argument('--domain', default='privacore.test', action='store',
+                        help='Domain of the test host (default: privacore.test)')
+    parser.add_argument('--sslkey', default='privacore.test.key', action='store',
+                        help='SSL key for the https requests test (default: privacore.test.key)')
+    parser.add_argument('--sslcert', default='privacore.test.cert', action='store',
+                        help='SSL certificate for the https requests test (default: privacore.test.cert)')
+    parser.add_argument('--no-https', dest='https', action='store_false',
+                        help='Skip https in the requests test')
+    parser.add_argument('--tls-protocol', choices=['TLSv1', 'negotiate'], default='TLSv1',
+                        help='TLS protocol of the https requests test, negotiate where openssl refuses TLSv1 '
+                             '(default: TLSv1)')
+    parser.add_argument('--loggingconf', type=str, default='logging.conf', action='store')
+
+    args = parser.parse_args()
+
+    keyfile = None
+    certfile = None
+    if args.https:
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+
+        if not os.path.exists(os.path.join(script_dir, args.sslkey)):
+            subprocess.call(['./create_ssl_key.sh', args.domain], stdout=subprocess.DEVNULL, cwd=script_dir)
+
+        if not os.path.exists(os.path.join(script_dir, args.sslcert)):
+            subprocess.call(['./create_ssl_cert.sh', args.domain], stdout=subprocess.DEVNULL, cwd=script_dir)
+
+        keyfile = args.sslkey
+        certfile = args.sslcert
+
+    main(args.benches or ['requests', 'capacity', 'throughput'], args.engines or ['threads', 'asyncio'], args.port,
+         args.connections, args.delay, args.timeout, args.loggingconf, args.large_size, args.clients, args.requests,
+         args.domain, keyfile, certfile, args.request_clients, args.request_count,
+         args.tls_protocol)